@@ -0,0 +1,205 @@
+# vim: set fileencoding=utf-8
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4 smartindent ft=python
+# pylint: disable=fixme,invalid-name
+
+"""
+end-to-end benchmark: run jira2zammad.py against the local jira and zammad
+stand-in servers and report issues/sec, requests per issue and peak RSS
+
+python3 -m bench.benchmark --issues 200 --latency 0.02 -- -w 8
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import resource
+import tempfile
+import subprocess
+
+from bench.fakejira import FakeJira
+from bench.fakezammad import FakeZammad
+
+logger = logging.getLogger(__name__)
+
+BASEDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+parser = argparse.ArgumentParser(
+    description='jira 2 zammad benchmark - args after -- are passed to jira2zammad.py',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+parser.add_argument('--issues', type=int, default=100, help='number of jira issues ... ')
+parser.add_argument('--users', type=int, default=20, help='number of jira users ... ')
+parser.add_argument('--comments', type=int, default=3, help='comments per issue ... ')
+parser.add_argument('--attachments', type=int, default=2, help='attachments per issue ... ')
+parser.add_argument('--attachmentsize', type=int, default=4096, help='attachment size ... ')
+parser.add_argument(
+    '--embeddedcomments', type=int,
+    help='max comments embedded in jira search results (like jira cloud) ... '
+    )
+parser.add_argument('--latency', type=float, default=0.0, help='latency of each request in s ... ')
+parser.add_argument(
+    '--jiralatency', type=float,
+    help='latency of each jira request in s (default: --latency) ... '
+    )
+parser.add_argument(
+    '--zammadlatency', type=float,
+    help='latency of each zammad request in s (default: --latency) ... '
+    )
+parser.add_argument(
+    '--errorrate', type=float, default=0.0,
+    help='share of the zammad requests failing with a 503 ... '
+    )
+parser.add_argument(
+    '--jiraerrorrate', type=float, default=0.0,
+    help='share of the jira requests failing with a 503 ... '
+    )
+parser.add_argument(
+    '--indexlag', type=float, default=0.0,
+    help='seconds until new zammad objects are found by the search ... '
+    )
+parser.add_argument(
+    '-c', '--config', type=str, nargs='+',
+    default=[os.path.join(BASEDIR, 'jira2zammad.yml')],
+    help='jira2zammad config files, the connection secrets are added ... '
+    )
+parser.add_argument(
+    '--ledger', action='store_true',
+    help='migrate with a ledger and a link graph file in the temporary directory ... '
+    )
+parser.add_argument('--json', type=str, help='write the results as json to this file ... ')
+parser.add_argument(
+    '-v', '--verbose', action='store_true',
+    help='show the output of jira2zammad.py ... '
+    )
+parser.add_argument(
+    'args', nargs=argparse.REMAINDER,
+    help='args for jira2zammad.py - relative paths are relative to the temporary directory'
+    )
+
+
+def write_secrets(filename, jira, zammad):
+    """write the connection settings for the stand-in servers"""
+    with open(filename, 'w', encoding='utf-8') as f:
+        f.write(
+            '---\n'
+            'jira:\n'
+            f'  baseurl: {jira.baseurl}\n'
+            '  authuser: bench\n'
+            '  authpass: bench\n'
+            f'  project: {jira.project}\n'
+            'zammad:\n'
+            f'  baseurl: {zammad.baseurl}api/v1/\n'
+            '  authtoken: bench\n'
+            )
+
+def run(args):  # pylint: disable=too-many-locals
+    """run the migration once, return the results"""
+    jiralatency = args.latency if args.jiralatency is None else args.jiralatency
+    zammadlatency = args.latency if args.zammadlatency is None else args.zammadlatency
+    jira = FakeJira(
+        issues=args.issues, users=args.users, comments=args.comments,
+        attachments=args.attachments, attachmentsize=args.attachmentsize,
+        embeddedcomments=args.embeddedcomments,
+        latency=jiralatency, errorrate=args.jiraerrorrate
+        ).start()
+    zammad = FakeZammad(
+        indexlag=args.indexlag, latency=zammadlatency, errorrate=args.errorrate
+        ).start()
+    extra = [arg for arg in args.args if arg != '--']
+    try:
+        with tempfile.TemporaryDirectory(prefix='j2z-bench-') as tmpdir:
+            secrets = os.path.join(tmpdir, 'secrets.yml')
+            write_secrets(secrets, jira, zammad)
+            # all state of the run is kept in the temporary directory, so no run
+            # reads the state of a earlier run (relative paths in the extra args
+            # are relative to it too)
+            cmd = [
+                sys.executable, os.path.join(BASEDIR, 'jira2zammad.py'),
+                '-c', *args.config, secrets,
+                '-d', os.path.join(tmpdir, 'damage.yml'),
+                ]
+            if args.ledger:
+                cmd += [
+                    '--linkgraph', os.path.join(tmpdir, 'links.jsonl'),
+                    '--ledger', os.path.join(tmpdir, 'ledger.db'),
+                    ]
+            cmd += extra
+            logger.info('run %s', ' '.join(cmd))
+            starttime = time.monotonic()
+            # pylint: disable-next=subprocess-run-check
+            result = subprocess.run(
+                cmd, cwd=tmpdir, text=True,
+                stdout=None if args.verbose else subprocess.PIPE,
+                stderr=None if args.verbose else subprocess.STDOUT
+                )
+            seconds = time.monotonic() - starttime
+    finally:
+        jira.stop()
+        zammad.stop()
+    if result.returncode and not args.verbose:
+        print(result.stdout[-4000:], file=sys.stderr)
+    # ru_maxrss of the children is the peak of the largest child, in KB on linux
+    peakrss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    jirarequests = jira.stats['_total']
+    zammadrequests = zammad.stats['_total']
+    issues = max(args.issues, 1)
+    return {
+        'returncode': result.returncode,
+        'seconds': round(seconds, 3),
+        'issues': args.issues,
+        'issues_per_sec': round(args.issues / seconds, 2),
+        'requests_per_issue': round((jirarequests + zammadrequests) / issues, 2),
+        'jira_requests_per_issue': round(jirarequests / issues, 2),
+        'zammad_requests_per_issue': round(zammadrequests / issues, 2),
+        'peak_rss_mb': round(peakrss, 1),
+        'errors_injected': jira.stats['_errors'] + zammad.stats['_errors'],
+        'tickets': len(zammad.tickets),
+        'articles': len(zammad.articles),
+        'links': len(zammad.links),
+        'users': len(zammad.users) - 1,
+        'attachments': zammad.attachments,
+        'jira_endpoints': {k: v for k, v in sorted(jira.stats.items()) if k[0] != '_'},
+        'zammad_endpoints': {k: v for k, v in sorted(zammad.stats.items()) if k[0] != '_'},
+        'args': extra,
+        }
+
+def report(results):
+    """print the results"""
+    print(
+        f"{results['issues']} issues in {results['seconds']:.2f}s: "
+        f"{results['issues_per_sec']:.2f} issues/sec, "
+        f"{results['requests_per_issue']:.2f} requests/issue "
+        f"(jira {results['jira_requests_per_issue']:.2f}, "
+        f"zammad {results['zammad_requests_per_issue']:.2f}), "
+        f"peak RSS {results['peak_rss_mb']:.1f} MB"
+        )
+    print(
+        f"zammad: {results['tickets']} tickets, {results['articles']} articles, "
+        f"{results['links']} links, {results['users']} users, "
+        f"{results['attachments']} attachments - "
+        f"{results['errors_injected']} errors injected"
+        )
+    for backend in ['jira', 'zammad']:
+        for endpoint, count in results[f'{backend}_endpoints'].items():
+            print(f'  {count:8d}  {endpoint}')
+
+def main():
+    """benchmark"""
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    results = run(args)
+    report(results)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write('\n')
+    if results['returncode']:
+        logger.error('jira2zammad.py failed with exit code %i', results['returncode'])
+    sys.exit(results['returncode'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,294 @@
+# vim: set fileencoding=utf-8
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4 smartindent ft=python
+# pylint: disable=fixme,invalid-name
+
+"""local stand-in for the jira rest api endpoints used by jira2zammad"""
+
+import re
+import json
+import random
+import threading
+import urllib.parse
+
+from bench.fakeserver import FakeServer, FakeHandler
+
+# pylint: disable=too-many-instance-attributes
+class FakeJira(FakeServer):
+    """generated jira project served via http"""
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    def __init__(
+            self, project='BENCH', issues=100, users=20, comments=3, attachments=2,
+            attachmentsize=4096, seed=42, embeddedcomments=None, **kwargs
+            ):
+        """
+        generate the project data
+        embeddedcomments limits the comments embedded in search results
+        """
+        super().__init__(FakeJiraHandler, **kwargs)
+        self.project = project
+        self.embeddedcomments = embeddedcomments
+        self.rand = random.Random(seed)
+        self.users = [self._user(i) for i in range(users)]
+        self.issues = []
+        self.attachmentdata = {}
+        self._lock = threading.Lock()
+        for i in range(1, issues + 1):
+            self.issues.append(self._issue(i, issues, comments, attachments, attachmentsize))
+
+    def _user(self, i):
+        """a jira user"""
+        email = f'user{i}@example.org'
+        # every 10th user has a broken email address in search results
+        if i % 10 == 9:
+            email = 'invalid'
+        return {
+            'self': f'{self.baseurl}rest/api/2/user?username=user{i}',
+            'key': f'juser{i}',
+            'name': f'user{i}',
+            'emailAddress': email,
+            'displayName': f'User {i}',
+            'active': True,
+            }
+
+    def _attachment(self, aid, author, size):
+        """a jira attachment"""
+        filename = f'file {aid}.png'
+        self.attachmentdata[str(aid)] = bytes(self.rand.getrandbits(8) for _ in range(size))
+        return {
+            'self': f'{self.baseurl}rest/api/2/attachment/{aid}',
+            'id': str(aid),
+            'filename': filename,
+            'author': author,
+            'created': '2020-01-01T10:00:00.000+0000',
+            'size': size,
+            'mimeType': 'image/png',
+            'content': f'{self.baseurl}secure/attachment/{aid}/{urllib.parse.quote(filename)}',
+            }
+
+    # pylint: disable=too-many-locals,too-many-arguments,too-many-positional-arguments
+    def _issue(self, num, total, ncomments, nattachments, attachmentsize):
+        """a jira issue with comments, attachments and links"""
+        iid = str(10000 + num)
+        key = f'{self.project}-{num}'
+        reporter = self.rand.choice(self.users)
+        assignee = self.rand.choice(self.users + [None])
+        attachments = [
+            self._attachment(num * 100 + a, reporter, attachmentsize)
+            for a in range(nattachments)
+            ]
+        comments = []
+        rcomments = []
+        for c in range(ncomments):
+            cid = str(num * 1000 + c)
+            body = f'comment {c} of {key}'
+            rbody = f'<p>comment {c} of {key}</p>'
+            author = reporter
+            if attachments and c == 0:
+                att = attachments[0]
+                body += f' [^{att["filename"]}]'
+                rbody += (
+                    f'<p><a href="{self.baseurl}secure/attachment/{att["id"]}/'
+                    f'{att["id"]}_{urllib.parse.quote_plus(att["filename"])}" '
+                    f'title="{att["filename"]} attached to {key}">{att["filename"]}</a></p>'
+                    )
+            if len(attachments) > 1 and c == 1:
+                att = attachments[1]
+                body += f' !{att["filename"]}|thumbnail!'
+                rbody += f'<p>!{att["filename"]}|thumbnail!</p>'
+            comment = {
+                'self': f'{self.baseurl}rest/api/2/issue/{iid}/comment/{cid}',
+                'id': cid,
+                'author': author,
+                'updateAuthor': author,
+                'body': body,
+                'created': '2020-01-02T10:00:00.000+0000',
+                'updated': '2020-01-02T10:00:00.000+0000',
+                # every 3rd comment is internal
+                'jsdPublic': c % 3 != 2,
+                }
+            comments.append(comment)
+            rcomments.append(dict(comment, body=rbody))
+        links = []
+        if num > 1 and num % 3 == 0:
+            target = self.rand.randint(1, total)
+            links.append({
+                'id': str(num),
+                'type': {
+                    'name': 'Blocks', 'inward': 'is blocked by', 'outward': 'blocks'
+                    },
+                'outwardIssue': {'id': str(10000 + target), 'key': f'{self.project}-{target}'},
+                })
+        return {
+            'id': iid,
+            'key': key,
+            'self': f'{self.baseurl}rest/api/2/issue/{iid}',
+            'fields': {
+                'summary': f'issue {num}',
+                'description': f'description of {key}',
+                'issuetype': {'name': 'Bug'},
+                'status': {'name': self.rand.choice(['Open', 'Closed', 'In Progress'])},
+                'reporter': reporter,
+                'assignee': assignee,
+                'created': '2020-01-01T09:00:00.000+0000',
+                'updated': '2020-01-03T09:00:00.000+0000',
+                'attachment': attachments,
+                'labels': self.rand.sample(['backup', 'network', 'mail', 'vpn', 'ab'], 2),
+                'components': [{'name': self.rand.choice(['server', 'client'])}],
+                'issuelinks': links,
+                'comment': {
+                    'comments': comments,
+                    'maxResults': len(comments),
+                    'total': len(comments),
+                    'startAt': 0,
+                    },
+                },
+            'renderedFields': {
+                'description': f'<p>description of {key}</p>',
+                'comment': {
+                    'comments': rcomments,
+                    'maxResults': len(comments),
+                    'total': len(comments),
+                    'startAt': 0,
+                    },
+                },
+            }
+
+    def find_issue(self, ident):
+        """find a issue by id or key"""
+        for issue in self.issues:
+            if ident in (issue['id'], issue['key']):
+                return issue
+        return None
+
+    # pylint: disable=too-many-branches
+    def search(self, params):
+        """very small jql subset: project = X / key in (...) / key > X / id > N"""
+        jql = params.get('jql', '')
+        issues = self.issues
+        keyin = re.search(r'key in \(([^)]*)\)', jql)
+        if keyin:
+            keys = [k.strip() for k in keyin.group(1).split(',')]
+            issues = [i for i in issues if i['key'] in keys]
+        keygt = re.search(r'key > "?([A-Z]+-\d+)"?', jql)
+        if keygt:
+            gtnum = int(keygt.group(1).split('-')[1])
+            issues = [i for i in issues if int(i['key'].split('-')[1]) > gtnum]
+        idgt = re.search(r'id > (\d+)', jql)
+        if idgt:
+            issues = [i for i in issues if int(i['id']) > int(idgt.group(1))]
+        start = int(params.get('startAt', 0))
+        maxresults = min(int(params.get('maxResults', 50)), 1000)
+        page = issues[start:start + maxresults]
+        fields = params.get('fields', '*all').split(',')
+        expand = params.get('expand', '') or ''
+        result = []
+        for issue in page:
+            rissue = {k: v for k, v in issue.items() if k not in ['fields', 'renderedFields']}
+            if '*all' in fields:
+                rissue['fields'] = dict(issue['fields'])
+            else:
+                rissue['fields'] = {
+                    k: v for k, v in issue['fields'].items() if k in fields
+                    }
+            if 'renderedFields' in expand:
+                rissue['renderedFields'] = {
+                    k: v for k, v in issue['renderedFields'].items()
+                    if k in rissue['fields']
+                    }
+            if self.embeddedcomments is not None and 'comment' in rissue['fields']:
+                # like jira cloud: the total is kept, but the list is truncated
+                for part in (rissue['fields'], rissue.get('renderedFields', {})):
+                    if 'comment' in part:
+                        part['comment'] = dict(
+                            part['comment'],
+                            comments=part['comment']['comments'][:self.embeddedcomments],
+                            maxResults=self.embeddedcomments
+                            )
+            result.append(rissue)
+        return {
+            'startAt': start,
+            'maxResults': maxresults,
+            'total': len(issues),
+            'isLast': start + maxresults >= len(issues),
+            'issues': result,
+            }
+
+    def comments(self, ident, params):
+        """comments of a issue"""
+        issue = self.find_issue(ident)
+        if not issue:
+            return None
+        rendered = 'renderedBody' in params.get('expand', '')
+        comments = []
+        for comment, rcomment in zip(
+                issue['fields']['comment']['comments'],
+                issue['renderedFields']['comment']['comments']
+                ):
+            comment = dict(comment)
+            public = comment.pop('jsdPublic', True)
+            if rendered:
+                comment['renderedBody'] = rcomment['body']
+            comment['properties'] = [
+                {'key': 'sd.public.comment', 'value': {'internal': not public}}
+                ]
+            comments.append(comment)
+        start = int(params.get('startAt', 0))
+        maxresults = min(int(params.get('maxResults', 5000)), 5000)
+        return {
+            'startAt': start,
+            'maxResults': maxresults,
+            'total': len(comments),
+            'comments': comments[start:start + maxresults],
+            }
+
+    def user(self, params):
+        """a single user - always with a valid email address"""
+        ident = params.get('username') or params.get('key')
+        for user in self.users:
+            if ident in (user['key'], user['name']):
+                return dict(user, emailAddress=f'{user["name"]}@example.org')
+        return None
+
+
+class FakeJiraHandler(FakeHandler):
+    """jira http handler"""
+    # pylint: disable=too-many-return-statements
+    def handle_request(self, method, path, params, _body):
+        """dispatch jira requests"""
+        server = self.server.fake
+        if method != 'GET':
+            return 405, {'errorMessages': ['not implemented']}
+        if path == '/rest/api/2/serverInfo':
+            return 200, {
+                'baseUrl': server.baseurl,
+                'version': '9.4.0',
+                'versionNumbers': [9, 4, 0],
+                'deploymentType': 'Server',
+                'serverTitle': 'fake jira',
+                }
+        if path == '/rest/api/2/field':
+            return 200, []
+        if path == '/rest/api/2/search':
+            return 200, server.search(params)
+        m = re.match(r'^/rest/api/2/issue/([^/]+)/comment$', path)
+        if m:
+            comments = server.comments(m.group(1), params)
+            if comments is None:
+                return 404, {'errorMessages': ['issue does not exist']}
+            return 200, comments
+        if path == '/rest/api/2/user':
+            user = server.user(params)
+            if user is None:
+                return 404, {'errorMessages': ['user does not exist']}
+            return 200, user
+        m = re.match(r'^/secure/attachment/(\d+)/', path)
+        if m:
+            data = server.attachmentdata.get(m.group(1))
+            if data is None:
+                return 404, {'errorMessages': ['attachment does not exist']}
+            return 200, data
+        return 404, {'errorMessages': [f'unknown path {path}']}
+
+
+if __name__ == '__main__':
+    print(json.dumps(FakeJira(issues=1).issues[0], indent=2))
@@ -0,0 +1,151 @@
+# vim: set fileencoding=utf-8
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4 smartindent ft=python
+# pylint: disable=fixme,invalid-name
+
+"""common base for the local jira and zammad stand-in servers"""
+
+import re
+import json
+import time
+import random
+import logging
+import threading
+import collections
+import urllib.parse
+import http.server
+
+logger = logging.getLogger(__name__)
+
+
+class FakeServer:  # pylint: disable=too-many-instance-attributes
+    """threaded http server with configurable latency and error rate"""
+    def __init__(self, handlerclass, host='127.0.0.1', port=0, latency=0.0, errorrate=0.0):
+        """bind the server - port 0 will choose a free port"""
+        self.latency = latency
+        self.errorrate = errorrate
+        self.stats = collections.Counter()
+        self._statslock = threading.Lock()
+        self._errorrand = random.Random(4711)
+        self.httpd = http.server.ThreadingHTTPServer((host, port), handlerclass)
+        self.httpd.daemon_threads = True
+        self.httpd.fake = self
+        self.baseurl = f'http://{host}:{self.httpd.server_address[1]}/'
+        self._thread = None
+
+    def start(self):
+        """serve in a background thread"""
+        self._thread = threading.Thread(
+            target=self.httpd.serve_forever, name=type(self).__name__, daemon=True
+            )
+        self._thread.start()
+        logger.info('%s listening on %s', type(self).__name__, self.baseurl)
+        return self
+
+    def stop(self):
+        """shutdown the server"""
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def count(self, endpoint):
+        """count a request - or a internal counter starting with _"""
+        with self._statslock:
+            self.stats[endpoint] += 1
+            if not endpoint.startswith('_'):
+                self.stats['_total'] += 1
+
+    def inject_error(self):
+        """decide if the current request should fail"""
+        if not self.errorrate:
+            return False
+        with self._statslock:
+            return self._errorrand.random() < self.errorrate
+
+
+class FakeHandler(http.server.BaseHTTPRequestHandler):
+    """json request handler - subclasses implement handle_request"""
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        """route the access log to logging"""
+        logger.debug(format, *args)
+
+    def handle_request(self, method, path, params, body):
+        """return (status, payload) - payload may be json data or bytes"""
+        raise NotImplementedError
+
+    def _dispatch(self, method):
+        """parse the request, apply latency/errors and send the response"""
+        fake = self.server.fake
+        url = urllib.parse.urlsplit(self.path)
+        # repeated parameters (fields=a&fields=b) are joined like jira does
+        params = {}
+        for k, v in urllib.parse.parse_qsl(url.query):
+            params[k] = f'{params[k]},{v}' if k in params else v
+        body = None
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            body = self.rfile.read(length)
+        elif self.headers.get('Transfer-Encoding') == 'chunked':
+            body = self._read_chunked()
+        if body:
+            try:
+                body = json.loads(body)
+            except ValueError:
+                pass
+        # ids and filenames in the path are not part of the endpoint name
+        endpoint = re.sub(r'(?<!/api)/[0-9]+(?=/|$)', '/:id', url.path)
+        endpoint = re.sub(r'^(/secure/attachment/:id)/.*$', r'\1/:filename', endpoint)
+        fake.count(f'{method} {endpoint}')
+        if fake.latency:
+            time.sleep(fake.latency)
+        if fake.inject_error():
+            fake.count('_errors')
+            self._send(503, {'error': 'injected error'}, {'Retry-After': '0'})
+            return
+        status, payload = self.handle_request(method, url.path, params, body)
+        self._send(status, payload)
+
+    def _read_chunked(self):
+        """read a chunked request body"""
+        data = b''
+        while True:
+            size = int(self.rfile.readline().strip(), 16)
+            if size == 0:
+                self.rfile.readline()
+                return data
+            data += self.rfile.read(size)
+            self.rfile.readline()
+
+    def _send(self, status, payload, headers=None):
+        """send a json or binary response"""
+        if isinstance(payload, bytes):
+            data = payload
+            ctype = 'application/octet-stream'
+        else:
+            data = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+            ctype = 'application/json'
+        self.send_response(status)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        """GET"""
+        self._dispatch('GET')
+
+    def do_POST(self):
+        """POST"""
+        self._dispatch('POST')
+
+    def do_PUT(self):
+        """PUT"""
+        self._dispatch('PUT')
+
+    def do_DELETE(self):
+        """DELETE"""
+        self._dispatch('DELETE')
@@ -0,0 +1,259 @@
+# vim: set fileencoding=utf-8
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4 smartindent ft=python
+# pylint: disable=fixme,invalid-name
+
+"""local stand-in for the zammad rest api endpoints used by jira2zammad"""
+
+import re
+import time
+import base64
+import threading
+
+from bench.fakeserver import FakeServer, FakeHandler
+
+ALREADY_EXISTS = {
+    'error': 'This object already exists.',
+    'error_human': 'This object already exists.',
+    }
+
+REVERSE_LINK_TYPE = {'normal': 'normal', 'parent': 'child', 'child': 'parent'}
+
+
+class FakeZammad(FakeServer):  # pylint: disable=too-many-instance-attributes
+    """in memory zammad with search index lag"""
+    def __init__(self, indexlag=0.0, **kwargs):
+        """init the data store"""
+        super().__init__(FakeZammadHandler, **kwargs)
+        self.indexlag = indexlag
+        self.lock = threading.RLock()
+        self.users = {}
+        self.tickets = {}
+        self.articles = {}
+        self.links = set()
+        self.attachmentbytes = 0
+        self.attachments = 0
+        self._ids = {'user': 1, 'ticket': 0, 'article': 0}
+        self.me = self._create_user({
+            'email': 'admin@example.org', 'login': 'admin', 'role_ids': [1, 2], 'active': True
+            })
+
+    def _nextid(self, kind):
+        """next object id"""
+        self._ids[kind] += 1
+        return self._ids[kind]
+
+    def _create_user(self, data):
+        """store a user"""
+        with self.lock:
+            uid = self._nextid('user')
+            user = {'id': uid, 'role_ids': [3], 'active': True, 'firstname': '', 'lastname': ''}
+            user.update(data)
+            user['id'] = uid
+            user['_indexed_at'] = time.monotonic() + self.indexlag
+            self.users[uid] = user
+            return user
+
+    def create_ticket(self, data):
+        """store a ticket and the first article"""
+        with self.lock:
+            tid = self._nextid('ticket')
+            article = data.pop('article', None)
+            tags = data.pop('tags', '') or ''
+            ticket = dict(data)
+            ticket['id'] = tid
+            ticket['number'] = str(31000 + tid)
+            ticket['tags'] = [t.strip() for t in tags.split(',') if t.strip()]
+            ticket['_indexed_at'] = time.monotonic() + self.indexlag
+            self.tickets[tid] = ticket
+        if article:
+            article['ticket_id'] = tid
+            self.create_article(article)
+        return ticket
+
+    def create_article(self, data):
+        """store a article"""
+        for attachment in data.get('attachments', []) or []:
+            raw = base64.b64decode(attachment['data'])
+            with self.lock:
+                self.attachments += 1
+                self.attachmentbytes += len(raw)
+            attachment['data'] = len(raw)
+        with self.lock:
+            aid = self._nextid('article')
+            article = dict(data, id=aid)
+            self.articles[aid] = article
+            return article
+
+    @staticmethod
+    def public(obj):
+        """strip internal keys"""
+        return {k: v for k, v in obj.items() if not k.startswith('_')}
+
+    def search(self, objects, query, params):
+        """search objects that are already indexed"""
+        now = time.monotonic()
+        matcher = QueryParser(query).parse()
+        with self.lock:
+            found = [
+                self.public(o) for o in objects.values()
+                if o['_indexed_at'] <= now and matcher(o)
+                ]
+        return self.paginate(found, params)
+
+    @staticmethod
+    def paginate(items, params):
+        """zammad style page / per_page"""
+        page = int(params.get('page', 1))
+        perpage = int(params.get('per_page', 100))
+        return items[(page - 1) * perpage:page * perpage]
+
+    def link_add(self, data):
+        """add a link - source by number, target by id"""
+        with self.lock:
+            source = None
+            for ticket in self.tickets.values():
+                if str(ticket['number']) == str(data['link_object_source_number']):
+                    source = ticket['id']
+            target = int(data['link_object_target_value'])
+            if source is None or target not in self.tickets:
+                return 422, {'error': 'No such ticket'}
+            link = (source, target, data.get('link_type', 'normal'))
+            reverse = (target, source, REVERSE_LINK_TYPE[link[2]])
+            if link in self.links or reverse in self.links:
+                return 422, ALREADY_EXISTS
+            self.links.add(link)
+            return 201, {}
+
+    def link_get(self, ticket_id):
+        """links of a ticket like Link.list of zammad"""
+        ticket_id = int(ticket_id)
+        links = []
+        with self.lock:
+            for source, target, linktype in self.links:
+                # like zammad: the type is reversed if the ticket is the source
+                if source == ticket_id:
+                    links.append({
+                        'link_type': REVERSE_LINK_TYPE[linktype], 'link_object': 'Ticket',
+                        'link_object_value': target
+                        })
+                elif target == ticket_id:
+                    links.append({
+                        'link_type': linktype, 'link_object': 'Ticket',
+                        'link_object_value': source
+                        })
+        return {'links': links, 'assets': {}}
+
+
+class QueryParser:  # pylint: disable=too-few-public-methods
+    """tiny subset of the elasticsearch query string syntax"""
+    TOKEN = re.compile(r'\s*(\(|\)|AND\b|OR\b|[^\s():]+:(?:"[^"]*"|[^\s()]+))')
+
+    def __init__(self, query):
+        """tokenize"""
+        self.tokens = self.TOKEN.findall(query)
+        self.pos = 0
+
+    def _peek(self):
+        """next token"""
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def parse(self):
+        """return a matcher fct."""
+        return self._or()
+
+    def _or(self):
+        """a OR b"""
+        parts = [self._and()]
+        while self._peek() == 'OR':
+            self.pos += 1
+            parts.append(self._and())
+        return lambda o: any(p(o) for p in parts)
+
+    def _and(self):
+        """a AND b"""
+        parts = [self._atom()]
+        while self._peek() == 'AND':
+            self.pos += 1
+            parts.append(self._atom())
+        return lambda o: all(p(o) for p in parts)
+
+    def _atom(self):
+        """(expr) or field:value"""
+        token = self._peek()
+        self.pos += 1
+        if token == '(':
+            matcher = self._or()
+            self.pos += 1  # )
+            return matcher
+        field, value = token.split(':', 1)
+        value = value.strip('"').lower()
+        if value.startswith('>'):
+            return lambda o: float(o.get(field) or 0) > float(value[1:])
+        def match(o):
+            ovalue = o.get(field)
+            if isinstance(ovalue, list):
+                return value in [str(v).lower() for v in ovalue]
+            return str(ovalue).lower() == value
+        return match
+
+
+class FakeZammadHandler(FakeHandler):
+    """zammad http handler"""
+    # pylint: disable=too-many-return-statements,too-many-branches
+    def handle_request(self, method, path, params, body):
+        """dispatch zammad requests"""
+        server = self.server.fake
+        path = path.replace('/api/v1', '', 1)
+        if path == '/users/me':
+            return 200, server.public(server.me)
+        if path == '/users/search':
+            return 200, server.search(server.users, params.get('query', ''), params)
+        if path == '/users':
+            if method == 'POST':
+                return 201, server.public(server._create_user(body))  # pylint: disable=protected-access
+            with server.lock:
+                users = [server.public(u) for u in server.users.values()]
+            return 200, server.paginate(users, params)
+        m = re.match(r'^/users/(\d+)$', path)
+        if m:
+            user = server.users.get(int(m.group(1)))
+            if not user:
+                return 404, {'error': 'not found'}
+            if method == 'PUT':
+                with server.lock:
+                    body.pop('roles', None)
+                    body.pop('id', None)
+                    user.update(body)
+            return 200, server.public(user)
+        if path == '/tickets/search':
+            return 200, server.search(server.tickets, params.get('query', ''), params)
+        if path == '/tickets' and method == 'POST':
+            return 201, server.public(server.create_ticket(body))
+        m = re.match(r'^/tickets/(\d+)$', path)
+        if m:
+            ticket = server.tickets.get(int(m.group(1)))
+            if not ticket:
+                return 404, {'error': 'not found'}
+            return 200, server.public(ticket)
+        if path == '/ticket_articles' and method == 'POST':
+            if int(body.get('ticket_id', 0)) not in server.tickets:
+                return 422, {'error': 'No such ticket'}
+            return 201, server.create_article(body)
+        if path == '/tags/add' and method == 'POST':
+            ticket = server.tickets.get(int(body['o_id']))
+            if not ticket:
+                return 422, {'error': 'No such ticket'}
+            with server.lock:
+                if body['item'] not in ticket['tags']:
+                    ticket['tags'].append(body['item'])
+            return 201, True
+        if path == '/tags':
+            ticket = server.tickets.get(int(params.get('o_id', 0)))
+            if not ticket:
+                return 404, {'error': 'not found'}
+            return 200, {'tags': list(ticket['tags'])}
+        if path == '/links/add' and method == 'POST':
+            return server.link_add(body)
+        if path == '/links':
+            return 200, server.link_get(params.get('link_object_value'))
+        return 404, {'error': f'unknown path {method} {path}'}
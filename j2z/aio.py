@@ -0,0 +1,301 @@
+# vim: set fileencoding=utf-8
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4 smartindent ft=python
+# pylint: disable=fixme,invalid-name
+
+"""helper functions for jira 2 zammad migration : asyncio engine"""
+
+import ssl
+import json
+import time
+import asyncio
+import functools
+import logging
+import concurrent.futures
+from requests.exceptions import HTTPError
+import j2z
+
+try:
+    import aiohttp
+except ImportError:  # optional - only required for the async engine
+    aiohttp = None
+
+logger = logging.getLogger(__name__)
+
+# client connectors
+jira = None
+zammad = None
+config = None
+
+
+class AsyncZammad:
+    """
+    non-blocking zammad client for the calls on the hot path
+    (ticket, article and tag creation)
+    it reuses url, auth and ssl settings of the ZammadAPI connector
+    """
+    def __init__(self, limit=100):
+        """init the client session - must be called inside the event loop"""
+        self.url = zammad.url
+        self._semaphore = asyncio.Semaphore(limit)
+        # rate limiter -> (event set on released slots, listener)
+        self._released = {}
+        sslarg = None  # aiohttp default: verify
+        if not zammad.session.verify:
+            sslarg = False
+        elif isinstance(zammad.session.verify, str):
+            sslarg = ssl.create_default_context(cafile=zammad.session.verify)
+        auth = None
+        if zammad.session.auth:
+            auth = aiohttp.BasicAuth(*zammad.session.auth)
+        self.session = aiohttp.ClientSession(
+            headers={k: v for k, v in zammad.session.headers.items() if k != 'Connection'},
+            auth=auth,
+            connector=aiohttp.TCPConnector(limit=limit, ssl=sslarg),
+            timeout=aiohttp.ClientTimeout(
+                connect=j2z.transport.TRANSPORT.timeout[0],
+                sock_read=j2z.transport.TRANSPORT.timeout[1]
+                )
+            )
+
+    async def close(self):
+        """close the client session"""
+        for limiter, (_released, listener) in self._released.items():
+            limiter.remove_listener(listener)
+        await self.session.close()
+
+    @staticmethod
+    async def _stream(body):
+        """yield the chunks of a streamed body, reading the spooled files in a thread"""
+        chunks = iter(body)
+        while True:
+            chunk = await asyncio.to_thread(next, chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+
+    async def request(self, method, path, payload=None):  # pylint: disable=too-many-locals
+        """
+        perform a request - raise HTTPError like zammad_py does
+        retries and the circuit breaker follow j2z.transport.TRANSPORT
+        """
+        transport = j2z.transport.TRANSPORT
+        url = self.url + path
+        endpoint = j2z.transport.get_endpoint(method, url)
+        retry = transport.retry
+        while True:
+            if not transport.breaker.allow(endpoint):
+                raise j2z.transport.CircuitOpenError(f'circuit open for {endpoint}')
+            limiter = transport.get_limiter(url)
+            if limiter:
+                await self._acquire(limiter)
+            starttime = time.monotonic()
+            try:
+                status, retryafter, text, size = await self._request(method, url, payload)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                transport.count('failed')
+                transport.breaker.record(endpoint, True)
+                if limiter:
+                    limiter.release()
+                if not (retry.total and self._is_retryable(retry, method, e)):
+                    raise
+                retry = retry.increment(method, url)
+                transport.count('retried')
+                await asyncio.sleep(retry.get_backoff_time())
+                continue
+            except BaseException:
+                # e.g. cancelled - the slot must not leak
+                if limiter:
+                    limiter.release()
+                raise
+            latency = time.monotonic() - starttime
+            j2z.metrics.METRICS.observe('request_seconds', latency, endpoint=endpoint)
+            if limiter:
+                limiter.release(
+                    latency if size <= j2z.transport.LATENCY_MAXBODY else None, status == 429
+                    )
+            if (retry.total and status >= 400
+                    and retry.is_retry(method, status, bool(retryafter))):
+                retry = retry.increment(method, url)
+                transport.count('retried')
+                await asyncio.sleep(
+                    retry.parse_retry_after(retryafter) if retryafter else retry.get_backoff_time()
+                    )
+                continue
+            transport.breaker.record(endpoint, status >= 500)
+            if status >= 400:
+                raise HTTPError(text)
+            break
+        try:
+            return json.loads(text)
+        except ValueError:
+            return text
+
+    @staticmethod
+    def _is_retryable(retry, method, error):
+        """
+        check if a failed request can be retried: idempotent requests, and all
+        requests that could not connect, as they were not sent
+        """
+        if isinstance(error, aiohttp.ClientConnectorError):
+            return True
+        return retry.allowed_methods is None or method.upper() in retry.allowed_methods
+
+    async def _acquire(self, limiter):
+        """wait for a request slot of the rate limiter - woken up by released slots"""
+        if limiter not in self._released:
+            loop = asyncio.get_running_loop()
+            released = asyncio.Event()
+            # slots are released by the threads of the blocking clients too
+            listener = functools.partial(loop.call_soon_threadsafe, released.set)
+            limiter.add_listener(listener)
+            self._released[limiter] = (released, listener)
+        released = self._released[limiter][0]
+        while True:
+            released.clear()
+            wait = limiter.try_acquire()
+            if wait == 0:
+                return
+            if wait is None:
+                await released.wait()
+            else:
+                await asyncio.sleep(wait)
+
+    async def _request(self, method, url, payload):
+        """perform a single request, return status, Retry-After header, text and body size"""
+        kwargs = {'json': payload}
+        size = 0
+        if payload is not None:
+            body = j2z.attachment.JSONBody(payload)
+            size = len(body)
+            if body.streamed:
+                kwargs = {
+                    'data': self._stream(body),
+                    'headers': {
+                        'Content-Type': 'application/json', 'Content-Length': str(len(body))
+                        },
+                    }
+        async with self._semaphore:
+            async with self.session.request(method, url, **kwargs) as response:
+                text = await response.text()
+                return response.status, response.headers.get('Retry-After'), text, size
+
+    async def ticket_create(self, params):
+        """create a ticket"""
+        return await self.request('POST', 'tickets', params)
+
+    async def ticket_article_create(self, params):
+        """create a ticket article"""
+        return await self.request('POST', 'ticket_articles', params)
+
+    async def ticket_tags(self, zammad_id):
+        """return the tags of a ticket"""
+        result = await self.request('GET', f'tags?object=Ticket&o_id={zammad_id}')
+        return result.get('tags', [])
+
+    async def ticket_tag_add(self, zammad_id, tag):
+        """add a tag to a ticket"""
+        return await self.request(
+            'POST', 'tags/add', {'o_id': zammad_id, 'item': tag, 'object': 'Ticket'}
+            )
+
+
+class AsyncEngine:
+    """
+    migrate issues using asyncio, running the pipeline of j2z.migrate
+    the blocking steps (jira, users, attachments, ledger) run in a pool of
+    `threads` threads; ticket, article and tag creation are non-blocking
+    up to `limit` issues are in flight, independent of the threads, so the
+    zammad requests of many issues overlap
+    """
+    def __init__(self, threads=32, limit=100, lookahead=False):
+        """init the engine"""
+        self.threads = threads
+        self.limit = limit
+        self.lookahead = lookahead
+        self.zammad = None
+
+    async def _add_tags(self, zammad_id, tags):
+        """add all tags at once"""
+        await asyncio.gather(*[self.zammad.ticket_tag_add(zammad_id, tag) for tag in tags])
+
+    async def execute(self, operation, *args):
+        """
+        execute a operation of the pipeline (see j2z.migrate.pipeline): blocking
+        calls run in the thread pool, zammad requests are non-blocking
+        """
+        if operation == 'call':
+            return await asyncio.to_thread(*args)
+        if operation == 'create':
+            if args[0] == 'ticket':
+                return await self.zammad.ticket_create(args[1])
+            return await self.zammad.ticket_article_create(args[1])
+        if operation == 'tags':
+            return await self.zammad.ticket_tags(args[0])
+        if operation == 'add_tags':
+            return await self._add_tags(*args)
+        raise ValueError(f'unknown pipeline operation {operation}')
+
+    async def migrate_issue(self, single_issue):
+        """async variant of j2z.migrate.migrate_issue, running the same pipeline"""
+        steps = j2z.migrate.pipeline(single_issue)
+        done, value = j2z.migrate.step(steps)
+        while not done:
+            try:
+                outcome = await self.execute(*value), None
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                outcome = None, e
+            done, value = j2z.migrate.step(steps, outcome)
+        return value
+
+    async def _migrate_issue(self, single_issue, issuelimit):
+        """migrate a issue and release the issue limit"""
+        try:
+            # the tasks share the threads, so only the phases are profiled
+            with j2z.profiling.PROFILER.issue(single_issue.key, cprofile=False):
+                return await self.migrate_issue(single_issue)
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            logger.error('unexpected error migrating %s: %s', single_issue.key, e)
+            j2z.metrics.METRICS.inc('issues_total', status='failed')
+            return False
+        finally:
+            j2z.attachment.PREFETCHER.release(single_issue.fields.attachment)
+            issuelimit.release()
+
+    async def run(self, pages):
+        """migrate all issues from the result pages"""
+        asyncio.get_running_loop().set_default_executor(
+            concurrent.futures.ThreadPoolExecutor(
+                # one more for the jira search
+                max_workers=self.threads + 1,
+                thread_name_prefix='j2z-aio'
+                )
+            )
+        self.zammad = AsyncZammad(self.limit)
+        issuelimit = asyncio.Semaphore(self.limit)
+        tasks = set()
+        pages = iter(pages)
+        try:
+            while True:
+                # jira search is blocking
+                reslist = await asyncio.to_thread(next, pages, None)
+                if reslist is None:
+                    break
+                for single_issue in reslist:
+                    if self.lookahead:
+                        j2z.attachment.PREFETCHER.prefetch(
+                            j2z.migrate.get_lookahead_attachments(single_issue)
+                            )
+                    await issuelimit.acquire()
+                    task = asyncio.create_task(self._migrate_issue(single_issue, issuelimit))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks)
+        finally:
+            await self.zammad.close()
+
+
+def migrate(pages, threads=32, limit=100, lookahead=False):
+    """run the async engine for all issues from the result pages"""
+    logger.info('async engine: %i threads, %i issues and zammad requests in flight', threads, limit)
+    asyncio.run(AsyncEngine(threads, limit, lookahead).run(pages))
@@ -4,10 +4,19 @@
 
 """helper functions for jira 2 zammad migration : issue / ticket attachments"""
 
+import os
 import logging
 import re
+import json
+import uuid
 import base64
+import hashlib
+import collections
+import tempfile
+import threading
 import urllib.parse
+import concurrent.futures
+import requests
 import j2z
 
 logger = logging.getLogger(__name__)
@@ -15,13 +24,368 @@ logger = logging.getLogger(__name__)
 zammad = None
 mapping = None
 
+# attachments larger than this are spooled to disk instead of memory
+SPOOLSIZE = 16 * 1024 * 1024
+# attachment references in the rendered html: links to a attachment or inline images
+ATTACHMENT_REFERENCE_PATTERN = re.compile(
+    r'<a\s[^>]*?href="(?P<href>[^"]*)"[^>]*>.*?</a>'
+    r'|!(?P<inline>[^|!\n<>]+)\|thumbnail!'
+    )
+ATTACHMENT_ID_PATTERN = re.compile(r'/secure/attachment/([0-9]+)/')
+
+# download and encoding buffer - a multiple of 3, so base64 chunks can be concatenated
+CHUNKSIZE = 3 * 64 * 1024
+
+
+class AttachmentData:
+    """
+    content of a downloaded attachment kept in a spooled temporary file
+    it is base64 encoded chunk by chunk while the request body is sent
+    """
+    def __init__(self, fileobj, size):
+        """init from a file object positioned anywhere"""
+        self.fileobj = fileobj
+        self.size = size
+
+    def __repr__(self):
+        """short repr, as zammad payloads are logged on errors"""
+        return f'<attachment data: {self.size} bytes>'
+
+    def __len__(self):
+        """length of the base64 encoded data"""
+        return 4 * ((self.size + 2) // 3)
+
+    def read(self):
+        """return the whole content"""
+        self.fileobj.seek(0)
+        return self.fileobj.read()
+
+    def iter_base64(self):
+        """yield the base64 encoded content"""
+        self.fileobj.seek(0)
+        while True:
+            chunk = self.fileobj.read(CHUNKSIZE)
+            if not chunk:
+                return
+            yield base64.b64encode(chunk)
+
+
+class JSONBody:
+    """
+    json request body that streams the attachment data of the payload
+    it can be iterated several times, e.g. for retries
+    """
+    def __init__(self, payload):
+        """encode the payload, attachment data is encoded while iterating"""
+        marker = f'j2z-attachment-{uuid.uuid4().hex}-'
+        datas = []
+        def placeholder(obj):
+            if isinstance(obj, AttachmentData):
+                datas.append(obj)
+                return f'{marker}{len(datas) - 1}'
+            raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+        parts = re.split(f'"{marker}([0-9]+)"', json.dumps(payload, default=placeholder))
+        # text, data index, text, data index, ..., text
+        self._parts = [
+            datas[int(part)] if i % 2 else part.encode('utf-8')
+            for i, part in enumerate(parts)
+            ]
+        self.streamed = bool(datas)
+
+    def __len__(self):
+        """content length"""
+        return sum(
+            len(part) + 2 if isinstance(part, AttachmentData) else len(part)
+            for part in self._parts
+            )
+
+    def __iter__(self):
+        """yield the body"""
+        for part in self._parts:
+            if isinstance(part, AttachmentData):
+                yield b'"'
+                yield from part.iter_base64()
+                yield b'"'
+            elif part:
+                yield part
+
+
+class AttachmentCache:  # pylint: disable=too-many-instance-attributes
+    """
+    content addressed attachment cache on disk
+    ids/<jira attachment id> contains the sha256 of the content, stored once in
+    blobs/<sha256>, so identical files attached to several issues are stored once;
+    if the cache exceeds maxsize the least recently used blobs and their ids are
+    removed until it is below the low water mark (lowwater * maxsize)
+    the lru order is kept in memory, the mtime of the blobs keeps it between runs
+    """
+    def __init__(self, cachedir=None, maxsize=10 * 1024 * 1024 * 1024, lowwater=0.9):
+        """init the cache - disabled without a cachedir"""
+        self.cachedir = cachedir
+        self.maxsize = maxsize
+        self.lowwater = lowwater
+        self._lock = threading.Lock()
+        self._size = 0
+        # sha256 -> (size, jira attachment ids), least recently used first
+        self._blobs = collections.OrderedDict()
+        # jira attachment id -> sha256
+        self._ids = {}
+        self.stats = {'hit': 0, 'miss': 0, 'dedup': 0, 'evicted': 0}
+        if cachedir:
+            for subdir in ['ids', 'blobs', 'tmp']:
+                os.makedirs(os.path.join(cachedir, subdir), exist_ok=True)
+            self._load()
+            logger.info('using attachment cache %s (%i bytes)', cachedir, self._size)
+            self._evict()
+    def _load(self):
+        """build the lru and id index from the cache dir, remove ids without blob"""
+        with os.scandir(os.path.join(self.cachedir, 'blobs')) as blobs:
+            entries = sorted(
+                (blob.stat().st_mtime, blob.name, blob.stat().st_size) for blob in blobs
+                )
+        for _mtime, sha, size in entries:
+            self._blobs[sha] = (size, set())
+            self._size += size
+        with os.scandir(os.path.join(self.cachedir, 'ids')) as ids:
+            for entry in ids:
+                with open(entry.path, encoding='utf-8') as idfile:
+                    sha = idfile.read().strip()
+                if sha in self._blobs:
+                    self._blobs[sha][1].add(entry.name)
+                    self._ids[entry.name] = sha
+                else:
+                    os.unlink(entry.path)
+    def isEnabled(self):
+        """return enabled status"""
+        return bool(self.cachedir)
+    def _blobpath(self, sha):
+        """path of a blob"""
+        return os.path.join(self.cachedir, 'blobs', sha)
+    def _idpath(self, attachment_id):
+        """path of the index entry of a jira attachment"""
+        return os.path.join(self.cachedir, 'ids', str(attachment_id))
+    def _touch(self, sha):
+        """mark a blob as recently used - must be called holding the lock"""
+        self._blobs.move_to_end(sha)
+        # the mtime keeps the lru order for the next run
+        os.utime(self._blobpath(sha))
+    def get(self, attachment):
+        """return AttachmentData from the cache or None"""
+        try:
+            with open(self._idpath(attachment.id), encoding='utf-8') as idfile:
+                sha = idfile.read().strip()
+            fileobj = open(self._blobpath(sha), 'rb')  # pylint: disable=consider-using-with
+        except OSError:
+            with self._lock:
+                self.stats['miss'] += 1
+            return None
+        size = os.fstat(fileobj.fileno()).st_size
+        if size != getattr(attachment, 'size', size):
+            logger.warning('cached attachment %s has a unexpected size', attachment.id)
+            fileobj.close()
+            with self._lock:
+                self.stats['miss'] += 1
+            return None
+        with self._lock:
+            if sha in self._blobs:
+                self._touch(sha)
+            self.stats['hit'] += 1
+        return AttachmentData(fileobj, size)
+    def put(self, attachment, chunks):
+        """store the content of a attachment and return AttachmentData"""
+        sha = hashlib.sha256()
+        size = 0
+        with tempfile.NamedTemporaryFile(dir=os.path.join(self.cachedir, 'tmp'), delete=False) as tmpfile:  # pylint: disable=line-too-long
+            try:
+                for chunk in chunks:
+                    tmpfile.write(chunk)
+                    sha.update(chunk)
+                    size += len(chunk)
+            except Exception:
+                os.unlink(tmpfile.name)
+                raise
+        sha = sha.hexdigest()
+        blobpath = self._blobpath(sha)
+        with self._lock:
+            if sha in self._blobs:
+                os.unlink(tmpfile.name)
+                self._touch(sha)
+                self.stats['dedup'] += 1
+            else:
+                os.replace(tmpfile.name, blobpath)
+                self._blobs[sha] = (size, set())
+                self._size += size
+            previous = self._ids.get(str(attachment.id))
+            if previous in self._blobs:
+                self._blobs[previous][1].discard(str(attachment.id))
+            self._blobs[sha][1].add(str(attachment.id))
+            self._ids[str(attachment.id)] = sha
+            with tempfile.NamedTemporaryFile('w', dir=os.path.join(self.cachedir, 'tmp'), delete=False, encoding='utf-8') as tmpfile:  # pylint: disable=line-too-long
+                tmpfile.write(sha)
+            os.replace(tmpfile.name, self._idpath(attachment.id))
+            # open before evicting, a open blob can still be read after it was removed
+            fileobj = open(blobpath, 'rb')  # pylint: disable=consider-using-with
+        self._evict()
+        return AttachmentData(fileobj, size)
+    def _evict(self):
+        """remove the least recently used blobs and their ids down to the low water mark"""
+        with self._lock:
+            if self._size <= self.maxsize:
+                return
+            while self._blobs and self._size > self.maxsize * self.lowwater:
+                sha, (size, ids) = self._blobs.popitem(last=False)
+                for attachment_id in ids:
+                    del self._ids[attachment_id]
+                    try:
+                        os.unlink(self._idpath(attachment_id))
+                    except FileNotFoundError:
+                        pass
+                try:
+                    os.unlink(self._blobpath(sha))
+                except FileNotFoundError:
+                    pass
+                self._size -= size
+                self.stats['evicted'] += 1
+                logger.debug('evicted %s from the attachment cache', sha)
+    def report(self):
+        """log the cache stats"""
+        if self.isEnabled():
+            with self._lock:
+                logger.warning(
+                    'attachment cache: %i hits, %i misses, %i duplicates, %i evicted, %i bytes',
+                    self.stats['hit'], self.stats['miss'], self.stats['dedup'],
+                    self.stats['evicted'], self._size
+                    )
+
+
+ATTACHMENT_CACHE = AttachmentCache()
+
+
+class AttachmentPrefetcher:
+    """
+    download the attachments of a issue in the background, so fetch will find
+    the data already present
+    the attachments that are prefetched per issue are limited by a byte budget
+    """
+    def __init__(self, workers=0, budget=64 * 1024 * 1024):
+        """init the prefetcher - disabled without workers"""
+        self.budget = budget
+        self._executor = None
+        if workers:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix='j2z-prefetch'
+                )
+        self._futures = {}
+        self._skipped = set()
+        self._lock = threading.Lock()
+        self.stats = {'hit': 0, 'skipped': 0}
+    def isEnabled(self):
+        """return enabled status"""
+        return self._executor is not None
+    def prefetch(self, attachments):
+        """start downloading the attachments of a issue"""
+        if not self.isEnabled():
+            return
+        budget = self.budget
+        with self._lock:
+            for attachment in attachments:
+                if attachment.id in self._futures or attachment.id in self._skipped:
+                    continue
+                size = getattr(attachment, 'size', 0)
+                if size > budget:
+                    self._skipped.add(attachment.id)
+                    self.stats['skipped'] += 1
+                    continue
+                budget -= size
+                self._futures[attachment.id] = self._executor.submit(_fetch, attachment)
+    def get(self, attachment):
+        """return the prefetched data of a attachment or None"""
+        with self._lock:
+            future = self._futures.pop(attachment.id, None)
+        if not future:
+            return None
+        try:
+            data = future.result()
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            logger.warning('prefetching attachment %s failed: %s', attachment.filename, e)
+            return None
+        with self._lock:
+            self.stats['hit'] += 1
+        return data
+    def release(self, attachments):
+        """forget the prefetched data of attachments that was not used"""
+        with self._lock:
+            futures = [self._futures.pop(a.id) for a in attachments if a.id in self._futures]
+            self._skipped.difference_update(a.id for a in attachments)
+        for future in futures:
+            future.cancel()
+    def report(self):
+        """log the prefetch stats"""
+        if self.isEnabled():
+            with self._lock:
+                logger.warning(
+                    'attachment prefetch: %i used, %i skipped (budget)',
+                    self.stats['hit'], self.stats['skipped']
+                    )
+
+
+PREFETCHER = AttachmentPrefetcher()
+
+
+def _download(attachment):
+    """yield the content of a attachment"""
+    # attachment.iter_content does not stream, as the ResilientSession of the jira
+    # client reads response.content, so we use the plain requests session request
+    response = requests.Session.request(
+        attachment._session, 'GET', attachment.content,  # pylint: disable=protected-access
+        headers={'Accept': '*/*'}, stream=True,
+        timeout=getattr(attachment._session, 'timeout', None)  # pylint: disable=protected-access
+        )
+    with response:
+        response.raise_for_status()
+        yield from response.iter_content(CHUNKSIZE)
+
+def fetch(attachment):
+    """return the content of a attachment - prefetched if possible"""
+    with j2z.profiling.PROFILER.phase('fetch'):
+        data = PREFETCHER.get(attachment)
+        if data:
+            return data
+        return _fetch(attachment)
+
+def _fetch(attachment):
+    """download a attachment into the attachment cache or a spooled temporary file"""
+    if ATTACHMENT_CACHE.isEnabled():
+        data = ATTACHMENT_CACHE.get(attachment)
+        if not data:
+            data = ATTACHMENT_CACHE.put(attachment, _download(attachment))
+            logger.debug('fetched attachment %s (%i bytes)', attachment.filename, data.size)
+        return data
+    fileobj = tempfile.SpooledTemporaryFile(max_size=SPOOLSIZE)  # pylint: disable=consider-using-with
+    size = 0
+    for chunk in _download(attachment):
+        fileobj.write(chunk)
+        size += len(chunk)
+    logger.debug('fetched attachment %s (%i bytes)', attachment.filename, size)
+    return AttachmentData(fileobj, size)
+
+def create(resource, params):
+    """create a zammad object like resource.create, but stream the attachment data"""
+    response = zammad.session.post(
+        resource.url,
+        data=JSONBody(params),
+        headers={'Content-Type': 'application/json'}
+        )
+    return resource._raise_or_return_json(response)  # pylint: disable=protected-access
+
 def jira2zammad(attachment):
     """transform a attachment from jira for zammad upload"""
     zattachment = {}
     zattachment['filename'] = attachment.filename
     zattachment['mime-type'] = attachment.mimeType
-    zattachment['data'] = base64.b64encode(attachment.get()).decode("utf-8")
-    #logger.debug('... zattachment data type: %s', type(zattachment['data']))
+    zattachment['data'] = fetch(attachment)
+    j2z.metrics.METRICS.inc('attachments_total')
+    j2z.metrics.METRICS.inc('attachment_bytes_total', attachment.size)
     return zattachment
 
 def jiraattachement2comment(zammad_id, attachment):
@@ -63,12 +427,27 @@ class JAtchments:
         self.config = config
         self.attachmentconfig = config['mapping'].get('attachment', {}).copy()
         self.jira_issue = jkey
+        self._ids = {ja.id for ja in self.attachments}
+        self._posted = set()
         logger.debug('created instance of JAtchments for %s', self.jira_issue)
 
     def get_attachments(self):
         """return attachments"""
         return self.attachments
 
+    def posted(self, attachment):
+        """mark a leftover attachment as posted"""
+        self._posted.add(attachment.id)
+
+    def get_used_ids(self):
+        """return the ids of the attachments matched in a article or posted"""
+        return (self._ids - {ja.id for ja in self.attachments}) | self._posted
+
+    def discard(self, attachment_ids):
+        """forget attachments that were already uploaded, i.e. when resuming a issue"""
+        self._posted.update(attachment_ids)
+        self.attachments = [ja for ja in self.attachments if ja.id not in self._posted]
+
     def _format(self, fstr, attachment):
         """format for re - parts will be re.escape'd"""
         filenameurl = urllib.parse.quote_plus(attachment.filename)
@@ -83,9 +462,21 @@ class JAtchments:
                     attachmentid=re.escape(attachment.id)
                 )
 
-    # pylint: disable=too-many-locals,too-many-branches
+    @staticmethod
+    def _author(attachment):
+        """return the lowercased user ident of the attachment author or None"""
+        try:
+            return j2z.user.get_jira_user_ident(attachment.author).lower()
+        except AttributeError:
+            return None
+
     def check_attachments_in_article(self, articletext, author):
         """detect if attachments are reference in the article text"""
+        with j2z.profiling.PROFILER.phase('attachments'):
+            return self._check_attachments_in_article(articletext, author)
+
+    def _check_attachments_in_article(self, articletext, author):
+        """see check_attachments_in_article"""
         attachment_matches = []
         if not author:
             return (False, attachment_matches, articletext)
@@ -97,14 +488,73 @@ class JAtchments:
             logger.debug('article "%s ..." by %s', articletext[:10], articleauthor)
         else:
             logger.debug('article "%s" by %s', articletext, articleauthor)
+        if self.attachmentconfig.get('resolver'):
+            return self._resolve(articletext, articleauthor)
+        return self._match_patterns(articletext, articleauthor)
+
+    def _resolve(self, articletext, articleauthor):
+        """
+        scan the article text once for attachment links and inline images and map
+        them to the attachments of the article author by id and filename
+        """
+        candidates = {a.id: a for a in self.attachments if self._author(a) == articleauthor}
+        if not articletext or not candidates:
+            return (False, [], articletext)
+        byname = {}
+        for attachment in candidates.values():
+            byname.setdefault(attachment.filename, attachment)
+            byname.setdefault(urllib.parse.unquote_plus(attachment.filename), attachment)
+        linked = {}
+        inlined = {}
+        def resolve(match):
+            if match.group('href') is not None:
+                idmatch = ATTACHMENT_ID_PATTERN.search(match.group('href'))
+                attachment = candidates.get(idmatch.group(1)) if idmatch else None
+                if not attachment:
+                    return match.group(0)
+                logger.debug('match: link to attachment %s', attachment.filename)
+                linked[attachment.id] = attachment
+                # we replace the link with the name of the attachment
+                return attachment.filename
+            attachment = byname.get(match.group('inline'))
+            if not attachment:
+                return match.group(0)
+            logger.debug('match: inline attachment %s', attachment.filename)
+            if attachment.id not in inlined:
+                # inline img  <img src="data:image/png;base64,...">
+                b64 = base64.b64encode(fetch(attachment).read()).decode("utf-8")
+                inlined[attachment.id] = (
+                    attachment,
+                    f'<div><img src="data:{attachment.mimeType};base64,{b64}"></div><br />'
+                    )
+            return inlined[attachment.id][1]
+        articletext = ATTACHMENT_REFERENCE_PATTERN.sub(resolve, articletext)
+        matched = {**linked, **{aid: inline[0] for aid, inline in inlined.items()}}
+        for attachment in matched.values():
+            self.attachments.remove(attachment)
+            articletext = self._replace(articletext, attachment)
+        return (bool(matched), list(linked.values()), articletext)
+
+    def _replace(self, articletext, attachment):
+        """apply the replace config for a matched attachment"""
+        for matchre, replace in self.attachmentconfig.get('replace', {}).items():
+            regexmatcher = self._format(matchre, attachment)
+            replacef = self._format(replace, attachment)
+            logger.debug(
+                '... replace "%s" w/ "%s" ....',
+                regexmatcher, replacef
+                )
+            articletext = re.sub(regexmatcher, replacef, articletext)
+        return articletext
+
+    def _match_patterns(self, articletext, articleauthor):
+        """match the attachments using the matchlink and matchinline patterns"""
+        attachment_matches = []
         matched = False
-        for attachment in self.attachments:
+        # matched attachments are removed from self.attachments
+        for attachment in list(self.attachments):
             amatched = False
-            attachmentauthor = None
-            try:
-                attachmentauthor = j2z.user.get_jira_user_ident(attachment.author).lower()
-            except AttributeError:
-                pass
+            attachmentauthor = self._author(attachment)
             if not articleauthor == attachmentauthor:
                 logger.debug(
                     '%s - attachmentauthor %s is not matching',
@@ -136,21 +586,14 @@ class JAtchments:
                         self.attachments.remove(attachment)
                         # inline img  <img src="data:image/png;base64,...">
                         mimetype = attachment.mimeType
-                        b64 = base64.b64encode(attachment.get()).decode("utf-8")
+                        b64 = base64.b64encode(fetch(attachment).read()).decode("utf-8")
                         inlineres = f'<div><img src="data:{mimetype};base64,{b64}"></div><br />'
                         articletext = re.sub(regexmatcher, inlineres, articletext)
                         matched = amatched = True
                         #logger.debug(articletext)
                         break
             if amatched:
-                for matchre, replace in self.attachmentconfig.get('replace', {}).items():
-                    regexmatcher = self._format(matchre, attachment)
-                    replacef = self._format(replace, attachment)
-                    logger.debug(
-                        '... replace "%s" w/ "%s" ....',
-                        regexmatcher, replacef
-                        )
-                    articletext = re.sub(regexmatcher, replacef, articletext)
+                articletext = self._replace(articletext, attachment)
         #logger.debug(attachment_matches)
         #logger.debug(articletext)
         return (matched, attachment_matches, articletext)
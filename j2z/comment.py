@@ -6,7 +6,7 @@
 
 import logging
 import j2z
-from jira import JIRAError
+from jira import JIRAError, Comment
 
 logger = logging.getLogger(__name__)
 
@@ -14,6 +14,64 @@ jira = None
 zammad = None
 mapping = None
 
+# take the comments from the issue search instead of one request per issue
+EMBEDDED_COMMENTS = False
+# expand parameter for the comments of a issue
+COMMENT_EXPAND = 'renderedBody,properties'
+
+def get_embedded_comments(issue):
+    """
+    return the comments embedded in the search result of a issue, with the
+    rendered body matched by id - None if the embedded list is truncated or
+    a comment lacks the service desk visibility (jsdPublic), as only the
+    properties of the fetched comments tell if it is internal
+    """
+    embedded = issue.raw['fields'].get('comment')
+    if embedded is None:
+        return None
+    if embedded.get('total', 0) > len(embedded.get('comments', [])):
+        logger.info(
+            'issue %s : %i of %i comments embedded, fetching all',
+            issue.key, len(embedded['comments']), embedded['total']
+            )
+        return None
+    if any('jsdPublic' not in rawcomment for rawcomment in embedded['comments']):
+        logger.info('issue %s : embedded comments without visibility, fetching all', issue.key)
+        return None
+    rendered = {
+        rcomment['id']: rcomment['body']
+        for rcomment in issue.raw.get('renderedFields', {}).get('comment', {}).get('comments', [])
+        }
+    comments = []
+    for rawcomment in embedded['comments']:
+        if rawcomment['id'] in rendered:
+            rawcomment = dict(rawcomment, renderedBody=rendered[rawcomment['id']])
+        # pylint: disable-next=protected-access
+        comments.append(Comment(jira._options, jira._session, raw=rawcomment))
+    return comments
+
+def fetch_comments(issue, pagesize=100):
+    """fetch all comments of a issue page by page"""
+    total = (issue.raw['fields'].get('comment') or {}).get('total')
+    comments = []
+    while total is None or len(comments) < total:
+        page = jira.comments(
+            issue.id, COMMENT_EXPAND, start_at=len(comments), max_results=pagesize
+            )
+        if not page:
+            break
+        comments.extend(page)
+    return comments
+
+def get_comments(issue):
+    """return the comments of a issue"""
+    if EMBEDDED_COMMENTS:
+        comments = get_embedded_comments(issue)
+        if comments is not None:
+            return comments
+        return fetch_comments(issue)
+    return jira.comments(issue.id, COMMENT_EXPAND)
+
 # https://jira.readthedocs.io/api.html#jira.client.JIRA.comments
 #
 # jira comment props
@@ -130,7 +188,8 @@ mapping = None
 def jira2zammad(zammad_id, jiracomment):
     """transform a jira comment into a zammad article"""
     zarticle = {}
-    zarticle = mapping['comment'].get('constants', {})
+    # copy the constants, as we must not modify the shared mapping
+    zarticle = mapping['comment'].get('constants', {}).copy()
     zarticle['ticket_id'] = zammad_id
     zarticle['attachments'] = []
     # we prefere renderedBody if expanded
@@ -152,7 +211,10 @@ def jira2zammad(zammad_id, jiracomment):
         zarticle[dfield] = jiracomment.updated
     # internal commment?
     zarticle['internal'] = False
-    for cprop in jiracomment.properties:
+    if not hasattr(jiracomment, 'properties') and hasattr(jiracomment, 'jsdPublic'):
+        # embedded comments carry the service desk visibility instead of the properties
+        zarticle['internal'] = not jiracomment.jsdPublic
+    for cprop in getattr(jiracomment, 'properties', []):
         if 'sd.public.comment' == cprop.key:
             if isinstance(cprop.value.internal, bool):
                 zarticle['internal'] = cprop.value.internal
@@ -4,7 +4,10 @@
 
 """helper functions for jira 2 zammad migration : issue / ticket"""
 
+import re
 import logging
+import threading
+import time
 import j2z
 
 logger = logging.getLogger(__name__)
@@ -14,8 +17,198 @@ jira = None
 zammad = None
 mapping = None
 
+# jira fields required besides the mapped fields:
+# log, attachments (and their default author), tags, links and timestamps
+REQUIRED_JIRA_FIELDS = [
+    'summary', 'reporter', 'attachment', 'labels', 'components', 'issuelinks',
+    'created', 'updated'
+    ]
+
+# jql that can be paged by key instead of an offset
+KEYSET_JQL_PATTERN = re.compile(r'^(?P<query>.+?)\s+ORDER\s+BY\s+key\s+ASC\s*$', re.IGNORECASE)
+
+
+class TicketIndex:
+    """
+    local index of migrated zammad tickets: issue ident -> ticket id and number
+    the tickets created or found by this run are always added, but only a
+    loaded index can tell that a ticket does not exist (isIndexed)
+    """
+    def __init__(self):
+        """init ticket index"""
+        self._enabled = False
+        self._identfield = None
+        self._INDEX = {}
+        self._lock = threading.Lock()
+    def isEnabled(self):
+        """return enabled status"""
+        return self._enabled
+    def isIndexed(self, issueidentfield):
+        """check if lookups by this zammad field can be answered by the index"""
+        return self._enabled and issueidentfield == self._identfield
+    def load(self, issueidentfield, perpage=100):
+        """
+        page through all tickets carrying the default tags once
+        we page by id instead of page numbers, as deep pages are limited
+        by the search index (max_result_window)
+        """
+        starttime = time.time()
+        zilter = ' AND '.join(f'tags:{ftag}' for ftag in mapping.get('tags', {}).get('default', []))
+        lastid = 0
+        with self._lock:
+            self._identfield = issueidentfield
+            self._INDEX = {}
+        # zammad_py keeps the per_page of a search for all later searches
+        defaultperpage = zammad.ticket.per_page
+        try:
+            while True:
+                query = f'id:>{lastid}'
+                if zilter:
+                    query = f'{zilter} AND {query}'
+                pages = zammad.ticket.search(
+                    query,
+                    filters={'per_page': perpage, 'sort_by': 'id', 'order_by': 'asc'}
+                    )
+                for ticket in pages:
+                    lastid = max(lastid, ticket['id'])
+                    if ticket.get(issueidentfield):
+                        self.add(ticket[issueidentfield], ticket)
+                if pages.is_last_page():
+                    break
+        finally:
+            zammad.ticket.per_page = defaultperpage
+        self._enabled = True
+        logger.warning(
+            'ticket index: %i tickets loaded in %.1fs',
+            len(self._INDEX), time.time() - starttime
+            )
+    def add(self, issueidentstr, zicket):
+        """store a (new) ticket in the index"""
+        with self._lock:
+            self._INDEX[str(issueidentstr)] = {'id': zicket['id'], 'number': zicket['number']}
+            if self._identfield:
+                self._INDEX[str(issueidentstr)][self._identfield] = issueidentstr
+    def get(self, issueidentstr):
+        """return the ticket from the index or None"""
+        with self._lock:
+            return self._INDEX.get(str(issueidentstr))
+
+
+TICKET_INDEX = TicketIndex()
+
+class PageSize:  # pylint: disable=too-few-public-methods
+    """
+    adapt the size of the jira search pages to the measured response time and
+    payload size of the previous page - grow up to twice or shrink down to half
+    the size per page, as the issues differ a lot (comments, attachments, ...)
+    """
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    def __init__(self, size=50, minsize=1, maxsize=1000, seconds=5.0, payload=8 * 1024 * 1024):
+        """init with the configured page size as starting value"""
+        self.size = max(size, minsize)
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self.seconds = seconds
+        self.payload = payload
+
+    def update(self, reslist, elapsed, payload=None):
+        """adapt the page size to a received page of payload bytes (None if unknown)"""
+        if not reslist:
+            return
+        if reslist.maxResults and reslist.maxResults < self.size:
+            # the server limits the page size
+            self.maxsize = reslist.maxResults
+        ideal = self.seconds * len(reslist) / max(elapsed, 0.001)
+        if payload is not None:
+            ideal = min(ideal, self.payload * len(reslist) / max(payload, 1))
+        size = int(min(max(ideal, self.size / 2), self.size * 2))
+        size = min(max(size, self.minsize), self.maxsize)
+        if size != self.size:
+            logger.info(
+                'jira search page size %i -> %i (%i issues in %.2fs, %s bytes)',
+                self.size, size, len(reslist), elapsed, payload
+                )
+        self.size = size
+
+
+def get_jira_search_fields():
+    """
+    return the fields and expand parameter for the jira issue search derived
+    from the mapping, so jira does not return and render fields we do not use
+    """
+    fields = list(REQUIRED_JIRA_FIELDS)
+    jidentfield = mapping.get('issue', {}).get('key', {}).get('jira', 'id')
+    if jidentfield not in ['id', 'key']:
+        fields.append(jidentfield)
+    mapped = [
+        jirafield for jirafield, zammadfield in mapping.get('issue', {}).get('fields', {}).items()
+        if zammadfield
+        ]
+    fields.extend(jirafield for jirafield in mapped if jirafield not in fields)
+    # jira2zammad uses the rendered description only
+    rendered = 'description' in mapped
+    if j2z.comment.EMBEDDED_COMMENTS:
+        # comments including the rendered body
+        fields.append('comment')
+        rendered = True
+    return fields, 'renderedFields' if rendered else None
+
+def search_jira_issues(jql, startat=0, maxresults=50):
+    """
+    iterate over the result pages of a jira issue search
+    jql ordered by key is paged by the last key of the previous page instead of
+    an offset: deep pages stay fast and issues created or moved during the run
+    do not shift the pages
+    startat and maxresults are the starting values
+    """
+    keyset = KEYSET_JQL_PATTERN.match(jql)
+    fields, expand = get_jira_search_fields()
+    logger.info('jira search fields: %s; expand: %s', ','.join(fields), expand)
+    pagesize = PageSize(maxresults)
+    lastkey = None
+    first = True
+    while True:
+        pjql = jql
+        if lastkey:
+            pjql = f'({keyset.group("query")}) AND key > "{lastkey}" ORDER BY key ASC'
+            logger.warning('loop %i issue starting after %s', pagesize.size, lastkey)
+        else:
+            logger.warning('loop %i issue starting from %i', pagesize.size, startat)
+        starttime = time.monotonic()
+        reslist = jira.search_issues(
+            jql_str=pjql,
+            startAt=startat,
+            maxResults=pagesize.size,
+            fields=fields,
+            expand=expand
+            )
+        if not reslist:
+            logger.info('reached end of issue loop!')
+            break
+        # the size of the search response, measured by the transport
+        pagesize.update(
+            reslist, time.monotonic() - starttime, j2z.transport.TRANSPORT.get_response_size()
+            )
+        if first:
+            # later keyset pages just count the remaining issues
+            j2z.metrics.METRICS.set('issues_expected', max(reslist.total - startat, 0))
+            first = False
+        # isLast : Note that this property is not returned for all operations.
+        islast = reslist.isLast or startat + len(reslist) >= reslist.total
+        yield reslist
+        if islast:
+            break
+        if keyset:
+            lastkey = reslist[-1].key
+            startat = 0
+        else:
+            startat = startat + len(reslist)
+
 def get_zammad_exactmatch(issueidentstr, issueidentfield='id'):
     """as the zammad search via api is not a exact match, we filter the result"""
+    if TICKET_INDEX.isIndexed(issueidentfield):
+        zicket = TICKET_INDEX.get(issueidentstr)
+        return [zicket] if zicket else []
     zilter = f'{issueidentfield}:{issueidentstr}'
     # filter by the tags applied by default
     for ftag in mapping.get('tags', {}).get('default', []):
@@ -4,7 +4,11 @@
 
 """helper functions for jira 2 zammad migration : issuelinks / ticket"""
 
+import os
+import json
 import logging
+import threading
+import concurrent.futures
 import j2z
 
 logger = logging.getLogger(__name__)
@@ -28,92 +32,233 @@ config = None
 # so in most cases just considering one direction should be sufficient
 # but in order to be sure we do not miss a link, we can consider both
 
-def get_mapped_issuelink(jissuelink):
+class LinkGraph:
     """
-    mapp a link from jira 2 zammad
-    return zammad target ticket, zammad link type
+    issue links recorded during the main pass, so they can be applied later
+    without fetching the issues from jira again
+    the file keeps the links of earlier runs, which are only applied for the
+    issues passed to sources (i.e. the issues of the ledger)
+    the links are appended to a json lines file, one record per link:
+    {"source": <ident>, "direction": "outwardIssue", "target": <ident>, "type": <jira link type>}
     """
-    logger.debug(jissuelink)
-    dir2consider = config.get('issuelinks', {}).get('directions', [])
-    #logger.debug(dir2consider)
-    target_issue_key = None
-    link_type = None
-    mapped_type = None
-    jidentfield = config['mapping']['issue']['key'].get('jira', 'id')
+    def __init__(self, filename=None):
+        """init the graph - not persisted without a filename"""
+        self.filename = filename
+        self.links = {}
+        # issues recorded in this run
+        self.recorded = set()
+        self._lock = threading.Lock()
+        if filename and os.path.exists(filename):
+            with open(filename, encoding='utf-8') as graphfile:
+                for line in graphfile:
+                    if line.strip():
+                        link = json.loads(line)
+                        self.links.setdefault(link['source'], set()).add(
+                            (link['direction'], link['target'], link['type'])
+                            )
+            logger.info(
+                'loaded %i issue links of %i issues from %s',
+                sum(len(links) for links in self.links.values()), len(self.links), filename
+                )
+    def record(self, issue):
+        """record the links of a jira issue"""
+        jidentfield = config['mapping']['issue']['key'].get('jira', 'id')
+        source = str(j2z.issue.get_jira_issue_identifier(issue, jidentfield))
+        links = set()
+        for jissuelink in issue.fields.issuelinks:
+            for direction in ['outwardIssue', 'inwardIssue']:
+                if not hasattr(jissuelink, direction):
+                    continue
+                target = j2z.issue.get_jira_issue_identifier(getattr(jissuelink, direction), jidentfield)
+                jtype = jissuelink.type.outward if direction == 'outwardIssue' else jissuelink.type.inward
+                links.add((direction, str(target), jtype))
+        with self._lock:
+            self.recorded.add(source)
+            new = links - self.links.get(source, set())
+            if not new:
+                return
+            self.links.setdefault(source, set()).update(new)
+            if self.filename:
+                with open(self.filename, 'a', encoding='utf-8') as graphfile:
+                    for direction, target, jtype in sorted(new):
+                        graphfile.write(json.dumps({
+                            'source': source, 'direction': direction,
+                            'target': target, 'type': jtype
+                            }) + '\n')
+    def get_links(self, source):
+        """return the recorded links (direction, target, jira link type) of a issue"""
+        with self._lock:
+            return sorted(self.links.get(str(source), set()))
+    def sources(self, idents=()):
+        """
+        return the issues with links recorded in this run, and the given issues
+        (e.g. from the ledger) with links recorded by earlier runs
+        """
+        with self._lock:
+            return sorted((self.recorded | {str(ident) for ident in idents}).intersection(self.links))
+
+
+LINK_GRAPH = LinkGraph()
+
+
+def map_link_type(direction, jtype):
+    """
+    map a jira link type in the given direction to a zammad link type
+    return None if the link should not be considered
+    """
+    if direction not in config.get('issuelinks', {}).get('directions', []):
+        return None
+    for ztype, jtypes in config.get('issuelinks', {}).get('mapping', {}).items():
+        if jtype in (jtypes if isinstance(jtypes, list) else [jtypes]):
+            return ztype
     if config.get('issuelinks', {}).get('match_all_unmapped_to_normal', False):
-        mapped_type = 'normal'
-    if 'outwardIssue' in dir2consider:
-        logger.debug('... check outwardIssue ...')
-        if hasattr(jissuelink, 'outwardIssue'):
-            if jidentfield == 'key':
-                target_issue_key = jissuelink.outwardIssue.key
-            elif jidentfield == 'id':
-                target_issue_key = jissuelink.outwardIssue.id
-            else:
-                logger.warning('issuelinks require key or id as mapping.issue.key.jira cfg')
-                return None, None
-            link_type = jissuelink.type.outward
-    if not target_issue_key and 'inwardIssue' in dir2consider:
-        logger.debug('... check inwardIssue ...')
-        if hasattr(jissuelink, 'inwardIssue'):
-            if jidentfield == 'key':
-                target_issue_key = jissuelink.inwardIssue.key
-            elif jidentfield == 'id':
-                target_issue_key = jissuelink.inwardIssue.id
-            else:
-                logger.warning('issuelinks require key or id as mapping.issue.key.jira cfg')
-                return None, None
-            link_type = jissuelink.type.inward
-    logger.debug('... %s -> %s', link_type, target_issue_key)
-    if target_issue_key:
-        for ztype, jtype in config.get('issuelinks', {}).get('mapping', {}).items():
-            if jtype == link_type:
-                mapped_type = ztype
-                break
+        return 'normal'
+    return None
+
+def canonical_link(source, target, link_type):
+    """
+    return a unique representation of a link
+    parent(a, b) is the same as child(b, a) and normal(a, b) the same as normal(b, a)
+    source and target must be of the same kind (jira idents or zammad ticket ids),
+    as the order of a normal link depends on them
+    """
+    if link_type == 'parent':
+        return (target, source, 'child')
+    if link_type == 'normal' and target < source:
+        return (target, source, 'normal')
+    return (source, target, link_type)
+
+
+class LinkEngine:
+    """
+    apply the recorded links to zammad
+    the links are normalized into unique edges, links that already exist in
+    zammad are skipped and the missing ones are created by a bounded pool
+    """
+    def __init__(self, workers=1):
+        """init the engine"""
+        self.workers = max(workers, 1)
+        self.stats = {'edges': 0, 'existing': 0, 'created': 0, 'failed': 0, 'unresolved': 0}
+        self._tickets = {}
+        self._lock = threading.Lock()
+
+    def _count(self, stat):
+        """increase a counter"""
+        with self._lock:
+            self.stats[stat] += 1
+
+    def edges(self, sources):
+        """return the unique (source ident, target ident, zammad link type) edges"""
+        edges = set()
+        for source in sources:
+            for direction, target, jtype in LINK_GRAPH.get_links(source):
+                link_type = map_link_type(direction, jtype)
+                logger.debug('... %s %s %s %s -> %s', source, direction, jtype, target, link_type)
+                if link_type:
+                    edges.add(canonical_link(source, target, link_type))
+        return edges
+
+    def _resolve(self, ident):
+        """
+        return id and number of the ticket of a jira issue from the ledger, the
+        local map or zammad - None if not found or the search failed
+        """
+        state = j2z.ledger.LEDGER.get(ident)
+        if state:
+            return {'id': state['id'], 'number': state['number']}
+        # the tickets created or found by this run
+        zicket = j2z.issue.TICKET_INDEX.get(ident)
+        if zicket:
+            return {'id': zicket['id'], 'number': zicket['number']}
         zidentfield = config['mapping']['issue']['key'].get('zammad', 'number')
-        target_zicked = j2z.issue.get_zammad_issue(target_issue_key, zidentfield)
-        return target_zicked, mapped_type
-    return None, None
-
-def jira2zammad(issue):
-    """transfer all issuelinks of a jira issue to zammad"""
-    logger.info(
-        'parse jira issue %s : %s',
-        issue.key, issue.fields.summary
-        )
-    jidentfield = config['mapping']['issue']['key'].get('jira', 'id')
-    jident = j2z.issue.get_jira_issue_identifier(issue, jidentfield)
-    zidentfield = config['mapping']['issue']['key'].get('zammad', 'number')
-    zicket = j2z.issue.get_zammad_issue(jident, issueidentfield=zidentfield)
-    if not zicket:
-        logger.error(
-            'unable to find matching ticket for issue %s=%s',
-            zidentfield, jident
-            )
-        return False
-    for ili in issue.fields.issuelinks:
-        target_zicket, ticketlinktype = get_mapped_issuelink(ili)
+        try:
+            zicket = j2z.issue.get_zammad_issue(ident, issueidentfield=zidentfield)
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            logger.error('unable to search ticket for issue %s=%s : %s', zidentfield, ident, e)
+            return None
+        if not zicket:
+            logger.error('unable to find matching ticket for issue %s=%s', zidentfield, ident)
+            return None
+        return {'id': zicket['id'], 'number': zicket['number']}
+
+    @staticmethod
+    def _existing(ticket_id):
+        """
+        return the canonical links (ticket id, ticket id, type) of a ticket in zammad
+        zammad lists a link from the point of view of the other ticket: the type
+        of a link with the ticket as source is reversed, so each listed link
+        is the link (other ticket, ticket, type)
+        return None if the links could not be listed
+        """
+        try:
+            zlinks = zammad.link.get(ticket_id).get('links', [])
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            logger.error('unable to list the links of ticket %s : %s', ticket_id, e)
+            return None
+        links = set()
+        for link in zlinks:
+            if link.get('link_object') == 'Ticket':
+                links.add(canonical_link(int(link['link_object_value']), ticket_id, link['link_type']))
+        return links
+
+    def _create(self, source, target, link_type):
+        """create a link - return True if created"""
         logger.debug(
-            '... process jira link %s ... %s -> %s',
-            ili, ticketlinktype, target_zicket
+            'create zammad ticket link %s -> %s of type %s',
+            source['number'], target['id'], link_type
             )
-        if target_zicket and ticketlinktype:
-            logger.debug(
-                'create zammad ticket link %s -> %s of type %s',
-                zicket['number'], target_zicket['id'], ticketlinktype
+        try:
+            zammad.link.add(
+                target['id'],        # link_object_target must be the ID
+                source['number'],    # link_object_source_number has to be the ticket number
+                link_type=link_type
                 )
-            try:
-                zammad.link.add(
-                    target_zicket['id'],  # link_object_target must be the ID
-                    zicket['number'],     # link_object_source_number has to be the ticket number
-                    link_type=ticketlinktype
-                    )
-            except Exception as zinke:  # pylint: disable=broad-exception-caught
-                if str(zinke.args[0]) == '{"error":"This object already exists.","error_human":"This object already exists."}':
-                    logger.debug('... duplicated link ... %s', zinke)
+        except Exception as zinke:  # pylint: disable=broad-exception-caught
+            logger.error(
+                'error creating zammad link  %s -> %s of type %s : %s',
+                source['number'], target['id'], link_type, zinke
+                )
+            self._count('failed')
+            return False
+        self._count('created')
+        return True
+
+    def apply(self, sources):
+        """apply the links of the given jira issues"""
+        edges = self.edges(sources)
+        self.stats['edges'] = len(edges)
+        if not edges:
+            return self.stats
+        idents = sorted({ident for edge in edges for ident in edge[:2]})
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix='j2z-link'
+                ) as executor:
+            self._tickets = dict(zip(idents, executor.map(self._resolve, idents)))
+            tickets = {}
+            resolved = set()
+            for source, target, link_type in sorted(edges):
+                if not self._tickets[source] or not self._tickets[target]:
+                    self.stats['unresolved'] += 1
+                    continue
+                tickets[self._tickets[source]['id']] = self._tickets[source]
+                tickets[self._tickets[target]['id']] = self._tickets[target]
+                # the order of the ticket ids may differ from the order of the idents
+                resolved.add(canonical_link(
+                    self._tickets[source]['id'], self._tickets[target]['id'], link_type
+                    ))
+            # every link is visible from both tickets, so checking the sources is sufficient
+            source_ids = sorted({source for source, _target, _link_type in resolved})
+            existing = dict(zip(source_ids, executor.map(self._existing, source_ids)))
+            missing = []
+            for source, target, link_type in sorted(resolved):
+                if existing[source] is None:
+                    # unknown if the link exists
+                    self.stats['failed'] += 1
+                elif (source, target, link_type) in existing[source]:
+                    self.stats['existing'] += 1
                 else:
-                    logger.error(
-                        'error creating zammad link  %s -> %s of type %s : %s',
-                        zicket['number'], target_zicket['id'], ticketlinktype, zinke
-                        )
-    return True
+                    missing.append((tickets[source], tickets[target], link_type))
+            list(executor.map(lambda edge: self._create(*edge), missing))
+        for stat in ['created', 'existing', 'failed', 'unresolved']:
+            j2z.metrics.METRICS.inc('links_total', self.stats[stat], status=stat)
+        return self.stats
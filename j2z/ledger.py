@@ -0,0 +1,123 @@
+# vim: set fileencoding=utf-8
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4 smartindent ft=python
+# pylint: disable=fixme,invalid-name
+
+"""helper functions for jira 2 zammad migration : per issue ledger"""
+
+import json
+import logging
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class IssueLedger:
+    """
+    record the migration state of each issue in a sqlite db, so a restart can
+    continue a issue where it stopped without searching zammad:
+    the ticket (id, number), the last posted comment, the attachments already
+    uploaded, and if the leftover attachments, the tags and the issue are done
+    all methods are no-ops if the ledger is disabled
+    """
+    def __init__(self, dbfile=None):
+        """open or create the ledger db - disabled without a dbfile"""
+        self.dbfile = dbfile
+        self._db = None
+        self._lock = threading.Lock()
+        if not dbfile:
+            return
+        self._db = sqlite3.connect(
+            dbfile,
+            timeout=60,
+            check_same_thread=False,
+            isolation_level=None  # autocommit, every step is persisted at once
+            )
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS issues ('
+            'jident TEXT PRIMARY KEY, zammad_id INTEGER NOT NULL, zammad_number TEXT NOT NULL, '
+            'last_comment INTEGER, attachments TEXT NOT NULL DEFAULT \'[]\', '
+            'leftovers_done INTEGER NOT NULL DEFAULT 0, tags_done INTEGER NOT NULL DEFAULT 0, '
+            'done INTEGER NOT NULL DEFAULT 0)'
+            )
+        count, done = self._db.execute(
+            'SELECT COUNT(*), COALESCE(SUM(done), 0) FROM issues'
+            ).fetchone()
+        logger.info('using issue ledger %s (%i issues, %i done)', dbfile, count, done)
+
+    def isEnabled(self):
+        """return enabled status"""
+        return self._db is not None
+
+    def _execute(self, sql, params):
+        """execute a statement if enabled"""
+        if self._db is None:
+            return
+        with self._lock:
+            self._db.execute(sql, params)
+
+    def get(self, jident):
+        """return the state of a issue or None"""
+        if self._db is None:
+            return None
+        with self._lock:
+            row = self._db.execute(
+                'SELECT zammad_id, zammad_number, last_comment, attachments, '
+                'leftovers_done, tags_done, done FROM issues WHERE jident = ?',
+                (str(jident),)
+                ).fetchone()
+        if not row:
+            return None
+        return {
+            'id': row[0],
+            'number': row[1],
+            'last_comment': row[2],
+            'attachments': json.loads(row[3]),
+            'leftovers_done': bool(row[4]),
+            'tags_done': bool(row[5]),
+            'done': bool(row[6]),
+            }
+
+    def idents(self):
+        """return the idents of all issues in the ledger"""
+        if self._db is None:
+            return []
+        with self._lock:
+            return [row[0] for row in self._db.execute('SELECT jident FROM issues')]
+
+    def ticketCreated(self, jident, zicket, attachment_ids):
+        """record a new ticket and the attachments of its first article"""
+        self._execute(
+            'INSERT OR REPLACE INTO issues (jident, zammad_id, zammad_number, attachments) '
+            'VALUES (?, ?, ?, ?)',
+            (str(jident), zicket['id'], str(zicket['number']), json.dumps(sorted(attachment_ids)))
+            )
+
+    def articlePosted(self, jident, attachment_ids, comment_id=None):
+        """record a posted comment or leftover attachment and all uploaded attachments"""
+        if comment_id is None:
+            self._execute(
+                'UPDATE issues SET attachments = ? WHERE jident = ?',
+                (json.dumps(sorted(attachment_ids)), str(jident))
+                )
+        else:
+            self._execute(
+                'UPDATE issues SET attachments = ?, last_comment = ? WHERE jident = ?',
+                (json.dumps(sorted(attachment_ids)), int(comment_id), str(jident))
+                )
+
+    def leftoversDone(self, jident):
+        """record that all leftover attachments are posted"""
+        self._execute('UPDATE issues SET leftovers_done = 1 WHERE jident = ?', (str(jident),))
+
+    def tagsDone(self, jident):
+        """record that all tags are added"""
+        self._execute('UPDATE issues SET tags_done = 1 WHERE jident = ?', (str(jident),))
+
+    def issueDone(self, jident):
+        """record that a issue is completely migrated"""
+        self._execute('UPDATE issues SET done = 1 WHERE jident = ?', (str(jident),))
+
+
+LEDGER = IssueLedger()
@@ -0,0 +1,215 @@
+# vim: set fileencoding=utf-8
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4 smartindent ft=python
+# pylint: disable=fixme,invalid-name
+
+"""helper functions for jira 2 zammad migration : metrics and progress"""
+
+import os
+import json
+import time
+import bisect
+import logging
+import datetime
+import threading
+
+logger = logging.getLogger(__name__)
+
+# name -> (type, help) of all metrics, exported with the prefix jira2zammad_
+METRICS_HELP = {
+    'issues_total': ('counter', 'jira issues processed by status'),
+    'comments_total': ('counter', 'jira comments processed by status'),
+    'attachments_total': ('counter', 'attachments sent to zammad'),
+    'attachment_bytes_total': ('counter', 'size of the attachments sent to zammad'),
+    'tags_total': ('counter', 'tags sent with new tickets or added later'),
+    'links_total': ('counter', 'issue links by status'),
+    'users_created_total': ('counter', 'zammad users created'),
+    'issues_expected': ('gauge', 'jira issues found by the search'),
+    'request_seconds': ('histogram', 'http request latency by endpoint'),
+    'index_lag_seconds': ('histogram', 'time until new objects are found in the search index'),
+    }
+
+# histogram buckets in seconds
+BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300]
+
+
+class Metrics:
+    """
+    counters, gauges and histograms of the migration
+    a background thread logs a progress line (throughput and ETA) and writes
+    the metrics to a prometheus node-exporter textfile
+    """
+    def __init__(self):
+        """init metrics"""
+        self._values = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self.starttime = time.time()
+        self.textfile = None
+
+    def inc(self, name, value=1, **labels):
+        """increase a counter"""
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            values = self._values.setdefault(name, {})
+            values[key] = values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """set a gauge"""
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values.setdefault(name, {})[key] = value
+
+    def observe(self, name, value, **labels):
+        """add a value to a histogram"""
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            hist = self._histograms.setdefault(name, {}).setdefault(
+                key, {'buckets': [0] * len(BUCKETS), 'sum': 0.0, 'count': 0}
+                )
+            pos = bisect.bisect_left(BUCKETS, value)
+            if pos < len(BUCKETS):
+                hist['buckets'][pos] += 1
+            hist['sum'] += value
+            hist['count'] += 1
+
+    def get(self, name, **labels):
+        """return the value of a counter or gauge - all labels if none are given"""
+        with self._lock:
+            values = self._values.get(name, {})
+            if labels:
+                return values.get(tuple(sorted(labels.items())), 0)
+            return sum(values.values())
+
+    def progress(self):
+        """return the progress line: issues, throughput and ETA"""
+        done = self.get('issues_total')
+        expected = self.get('issues_expected')
+        elapsed = max(time.time() - self.starttime, 0.001)
+        rate = done / elapsed
+        eta = '?'
+        if expected and rate:
+            eta = str(datetime.timedelta(seconds=int(max(expected - done, 0) / rate)))
+        return (
+            f'progress: {done}/{expected or "?"} issues '
+            f'({self.get("issues_total", status="migrated")} migrated, '
+            f'{self.get("issues_total", status="skipped")} skipped, '
+            f'{self.get("issues_total", status="failed")} failed) - '
+            f'{rate * 3600:.0f} issues/h - ETA {eta} - '
+            f'{self.get("comments_total")} comments, '
+            f'{self.get("attachments_total")} attachments '
+            f'({self.get("attachment_bytes_total") / 1024 / 1024:.1f} MB)'
+            )
+
+    @staticmethod
+    def _labels(key, extra=None):
+        """format the labels of a metric"""
+        labels = list(key) + (extra or [])
+        if not labels:
+            return ''
+        escaped = [
+            (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels
+            ]
+        return '{' + ','.join(f'{k}="{v}"' for k, v in escaped) + '}'
+
+    def prometheus(self):
+        """return the metrics in the prometheus text format"""
+        lines = []
+        with self._lock:
+            for name, (mtype, mhelp) in METRICS_HELP.items():
+                fullname = f'jira2zammad_{name}'
+                if name not in self._values and name not in self._histograms:
+                    continue
+                lines.append(f'# HELP {fullname} {mhelp}')
+                lines.append(f'# TYPE {fullname} {mtype}')
+                for key, value in sorted(self._values.get(name, {}).items()):
+                    lines.append(f'{fullname}{self._labels(key)} {value}')
+                for key, hist in sorted(self._histograms.get(name, {}).items()):
+                    cumulative = 0
+                    for le, count in zip(BUCKETS, hist['buckets']):
+                        cumulative += count
+                        lines.append(
+                            f'{fullname}_bucket{self._labels(key, [("le", le)])} {cumulative}'
+                            )
+                    lines.append(
+                        f'{fullname}_bucket{self._labels(key, [("le", "+Inf")])} {hist["count"]}'
+                        )
+                    lines.append(f'{fullname}_sum{self._labels(key)} {hist["sum"]:.6f}')
+                    lines.append(f'{fullname}_count{self._labels(key)} {hist["count"]}')
+            lines.append('# HELP jira2zammad_start_time_seconds start of the migration')
+            lines.append('# TYPE jira2zammad_start_time_seconds gauge')
+            lines.append(f'jira2zammad_start_time_seconds {self.starttime:.0f}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """return all metrics as a dict"""
+        with self._lock:
+            values = {
+                name: {','.join(f'{k}={v}' for k, v in key) or 'total': value
+                       for key, value in values.items()}
+                for name, values in self._values.items()
+                }
+            histograms = {
+                name: {','.join(f'{k}={v}' for k, v in key) or 'total': {
+                    'count': hist['count'],
+                    'sum': round(hist['sum'], 6),
+                    'avg': round(hist['sum'] / max(hist['count'], 1), 6),
+                    } for key, hist in hists.items()}
+                for name, hists in self._histograms.items()
+                }
+        return {
+            'start': datetime.datetime.fromtimestamp(self.starttime).isoformat(),
+            'seconds': round(time.time() - self.starttime, 3),
+            'metrics': values,
+            'histograms': histograms,
+            }
+
+    @staticmethod
+    def _write(filename, content):
+        """replace a file atomically, so readers never see a partial file"""
+        tmpfile = f'{filename}.{os.getpid()}.tmp'
+        with open(tmpfile, 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.replace(tmpfile, filename)
+
+    def write_textfile(self):
+        """write the prometheus textfile if configured"""
+        if not self.textfile:
+            return
+        try:
+            self._write(self.textfile, self.prometheus())
+        except OSError as e:
+            logger.error('unable to write metrics to %s: %s', self.textfile, e)
+
+    def write_summary(self, filename):
+        """write the json summary"""
+        self._write(filename, json.dumps(self.summary(), indent=2, sort_keys=True) + '\n')
+        logger.warning('metrics summary written to %s', filename)
+
+    def start(self, interval=60, textfile=None):
+        """log the progress and write the textfile every interval seconds"""
+        self.textfile = textfile
+        if not interval:
+            return
+        self._thread = threading.Thread(
+            target=self._run, args=(interval,), name='j2z-metrics', daemon=True
+            )
+        self._thread.start()
+
+    def _run(self, interval):
+        """background progress loop"""
+        while not self._stop.wait(interval):
+            logger.warning(self.progress())
+            self.write_textfile()
+
+    def stop(self):
+        """stop the progress loop and write the final state"""
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        logger.warning(self.progress())
+        self.write_textfile()
+
+
+METRICS = Metrics()
@@ -0,0 +1,345 @@
+# vim: set fileencoding=utf-8
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4 smartindent ft=python
+# pylint: disable=fixme,invalid-name
+
+"""helper functions for jira 2 zammad migration : per issue pipeline"""
+
+import logging
+import j2z
+
+logger = logging.getLogger(__name__)
+
+# client connectors
+jira = None
+zammad = None
+config = None
+
+def get_identifiers(single_issue):
+    """return jira ident field, jira ident and zammad ident field of a issue"""
+    jidentfield = config['mapping']['issue']['key'].get('jira', 'id')
+    jident = j2z.issue.get_jira_issue_identifier(single_issue, jidentfield)
+    zidentfield = config['mapping']['issue']['key'].get('zammad', 'number')
+    logger.debug(
+        'jidentfield: %s; jident: %s; zidentfield: %s',
+        jidentfield, jident, zidentfield
+        )
+    return jidentfield, jident, zidentfield
+
+def prepare_ticket(single_issue, jident, jatchments):
+    """
+    transform a jira issue into zammad ticket data incl. the attachments
+    referenced in the description
+    return None if the issue can not be translated
+    """
+    try:
+        zicket_data = j2z.issue.jira2zammad(single_issue)
+    except Exception as zicketdataexception:  # pylint: disable=broad-exception-caught
+        #import traceback
+        #traceback.print_exc()
+        logger.error(
+            'unable to translate data from jira 2 zammad for %s : %s',
+            jident, zicketdataexception
+            )
+        return None
+    # attachments can be in the description too
+    if zicket_data.get('article', {}).get('body'):
+        attamatched, attachments, body = jatchments.check_attachments_in_article(
+                zicket_data['article']['body'],
+                single_issue.get_field('reporter')
+            )
+        if attamatched:
+            logger.info(
+                'issue %s : updated description because of attachments (%i)',
+                jident, len(attachments)
+                )
+            zicket_data['article']['body'] = body
+            for attachment in attachments:
+                zattchment = j2z.attachment.jira2zammad(attachment)
+                zicket_data['article']['attachments'].append(zattchment)
+    # all tags are set with the new ticket instead of one request per tag
+    zicket_data['tags'] = j2z.tags.join_tags(j2z.tags.get_tags(single_issue))
+    # TODO: mention in comments and description
+    # <a class="user-hover" href="https://<JIRA>/secure/ViewProfile.jspa?name=<LOGIN>"><SNAME, FNAME></a>  # pylint: disable=line-too-long
+    # <a href=\"https://<ZAMMAD>/#user/profile/<ID>\" data-mention-user-id=\"<ID>\"><FNAME SNAME></a>      # pylint: disable=line-too-long
+    logger.debug('zicket_data ...')
+    logger.debug(zicket_data)
+    return zicket_data
+
+def prepare_comment(zammad_id, jiracomment, jident, jatchments):
+    """transform a jira comment into a zammad article incl. referenced attachments"""
+    logger.debug('... jiracomment %s', jiracomment)
+    zarticle = {}
+    zarticle = j2z.comment.jira2zammad(zammad_id, jiracomment)
+    # attachments in comment
+    if zarticle.get('body'):
+        attamatched = False
+        attamatched, attachments, body = jatchments.check_attachments_in_article(zarticle['body'], jiracomment.author)  # pylint: disable=line-too-long
+        if attamatched:
+            logger.info(
+                'issue %s : updated comment "%s ..." because of attachments (%i)',
+                jident, body[:10], len(attachments)
+                )
+            zarticle['body'] = body
+            for attachment in attachments:
+                logger.debug(
+                    'issue %s : comment "%s ..." - append attachment %s',
+                    jident, body[:10], attachment.filename
+                    )
+                zattchment = j2z.attachment.jira2zammad(attachment)
+                zarticle['attachments'].append(zattchment)
+    #logger.debug('zarticle updated ... attachments: %s', zarticle.get('attachments'))
+    #logger.debug('zarticle ...')
+    #logger.debug(zarticle)
+    return zarticle
+
+def migrate_issue(single_issue):
+    """
+    migrate a single jira issue: ticket, comments, leftover attachments and tags
+    all steps for one issue run in order, so this can be used as a unit of work
+    for parallel workers
+    return True if the issue was migrated
+    """
+    try:
+        with j2z.profiling.PROFILER.issue(single_issue.key):
+            return run_pipeline(pipeline(single_issue), execute)
+    finally:
+        j2z.attachment.PREFETCHER.release(single_issue.fields.attachment)
+
+def execute(operation, *args):
+    """execute a operation of the pipeline (see pipeline) using the blocking clients"""
+    if operation == 'call':
+        return args[0](*args[1:])
+    if operation == 'create':
+        return j2z.attachment.create(getattr(zammad, args[0]), args[1])
+    if operation == 'tags':
+        return zammad.ticket.tags(args[0]).get('tags', [])
+    if operation == 'add_tags':
+        for tag in args[1]:
+            zammad.ticket_tag.add(args[0], tag)
+        return None
+    raise ValueError(f'unknown pipeline operation {operation}')
+
+def run_pipeline(steps, executor):
+    """run a pipeline with a executor of its operations - return its result"""
+    done, value = step(steps)
+    while not done:
+        try:
+            outcome = executor(*value), None
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            outcome = None, e
+        done, value = step(steps, outcome)
+    return value
+
+def step(steps, outcome=(None, None)):
+    """
+    continue a pipeline with the outcome (result, exception) of the last operation:
+    the result is sent back, the exception is thrown into the pipeline
+    return (False, next operation) or (True, result of the pipeline)
+    """
+    result, error = outcome
+    try:
+        return False, steps.throw(error) if error else steps.send(result)
+    except StopIteration as stop:
+        return True, stop.value
+
+def get_issue_state(jident, jidentfield, zidentfield):
+    """
+    return (skip, state) of a issue: skip if the issue is already migrated and
+    the ledger state if a issue was started before
+    """
+    state = j2z.ledger.LEDGER.get(jident)
+    if state and state['done']:
+        logger.warning('jira issue %s already migrated as zammad ticket %i', jident, state['id'])
+        return True, state
+    if state:
+        logger.warning('resume jira issue %s (zammad ticket %i)', jident, state['id'])
+        return False, state
+    zickets = j2z.issue.get_zammad_exactmatch(jident, issueidentfield=zidentfield)
+    if zickets:
+        if len(zickets) == 1:
+            # e.g. to resolve the links without a search
+            j2z.issue.TICKET_INDEX.add(jident, zickets[0])
+        logger.warning(
+            'jira issue %s=%s already exists in zammad (%s=%s)',
+            jidentfield, jident, zidentfield, jident
+            )
+        return True, None
+    return False, None
+
+def is_comment_posted(state, jiracomment):
+    """check if a comment was posted before according to the ledger"""
+    return bool(
+        state and state['last_comment'] is not None
+        and int(jiracomment.id) <= state['last_comment']
+        )
+
+def get_lookahead_attachments(single_issue):
+    """
+    return the attachments of a issue waiting for a worker to prefetch: none if
+    the issue is already migrated, the ones not uploaded before if the ledger knows
+    the issue - and none if only a zammad search could tell if it is migrated, as
+    the ledger or the ticket index are required to know that
+    """
+    _jidentfield, jident, zidentfield = get_identifiers(single_issue)
+    state = j2z.ledger.LEDGER.get(jident)
+    if state:
+        if state['done']:
+            return []
+        return [a for a in single_issue.fields.attachment if a.id not in state['attachments']]
+    if j2z.issue.TICKET_INDEX.isIndexed(zidentfield):
+        if j2z.issue.TICKET_INDEX.get(jident):
+            return []
+        return single_issue.fields.attachment
+    if j2z.ledger.LEDGER.isEnabled():
+        return single_issue.fields.attachment
+    return []
+
+def stop_issue(jident, article):
+    """
+    stop a issue at a failed article: the ledger keeps the issue at the last
+    created article, so a next run resumes it from the failed article
+    """
+    logger.error(
+        'jira issue %s stopped at the failed %s, run again to resume the issue', jident, article
+        )
+    j2z.metrics.METRICS.inc('issues_total', status='failed')
+    return False
+
+# pylint: disable=too-many-locals,too-many-branches,too-many-statements,too-many-return-statements
+def pipeline(single_issue):
+    """
+    the steps to migrate a single jira issue, shared by the sync and the async
+    engine: a generator yielding the operations that block or talk to zammad
+    and receiving their results (exceptions are thrown into the generator)
+      ('call', function, *args)        : blocking call (jira, ledger, mapping)
+      ('create', resource, params)     : create a zammad ticket or ticket_article
+      ('tags', zammad_id)              : return the tags of a ticket
+      ('add_tags', zammad_id, tags)    : add tags to a ticket
+    return True if the issue was migrated
+    """
+    profiler = j2z.profiling.PROFILER
+    metrics = j2z.metrics.METRICS
+    ledger = j2z.ledger.LEDGER
+    logger.info('parse jira issue %s : %s', single_issue.key, single_issue.fields.summary)
+    # the links are applied after all issues are migrated
+    j2z.issuelink.LINK_GRAPH.record(single_issue)
+    jidentfield, jident, zidentfield = get_identifiers(single_issue)
+    skip, state = yield 'call', get_issue_state, jident, jidentfield, zidentfield
+    if skip:
+        metrics.inc('issues_total', status='skipped')
+        return False
+    # attachments:
+    # the main problem here is, that attachments in zammad are bound to articles
+    # and in jira to issues with optional occurence in comments as link or inline
+    jatchments = j2z.attachment.JAtchments(
+        single_issue.fields.attachment,
+        single_issue.key,
+        config
+        )
+    if state:
+        zicket = {'id': state['id'], 'number': state['number']}
+        jatchments.discard(state['attachments'])
+    # just the attachments still to upload
+    j2z.attachment.PREFETCHER.prefetch(jatchments.get_attachments())
+    # the tags of the ticket, unknown for a resumed issue
+    applied = None
+    if not state:
+        with profiler.phase('transform'):
+            zicket_data = yield 'call', prepare_ticket, single_issue, jident, jatchments
+        if zicket_data is None:
+            metrics.inc('issues_total', status='failed')
+            return False
+        try:
+            with profiler.phase('create'):
+                zicket = yield 'create', 'ticket', zicket_data
+            applied = zicket.get('tags', zicket_data['tags'])
+            if isinstance(applied, str):
+                applied = applied.split(',')
+            yield 'call', ledger.ticketCreated, jident, zicket, jatchments.get_used_ids()
+            j2z.issue.TICKET_INDEX.add(jident, zicket)
+            logger.warning('jira issue %s created as zammad ticket %i ...', jident, zicket['id'])
+            # new tickets require some time until they can be found, this is verified
+            # in the background - unless the ticket index answers the lookups
+            if not j2z.issue.TICKET_INDEX.isIndexed(zidentfield):
+                j2z.readiness.INDEX_READINESS.expect_ticket(jident, zicket)
+        except Exception as zicketexception:  # pylint: disable=broad-exception-caught
+            logger.error('unable to create zammad issue for %s : %s', jident, zicketexception)
+            logger.error(zicket_data)
+            metrics.inc('issues_total', status='failed')
+            return False
+    with profiler.phase('fetch'):
+        clist = yield 'call', j2z.comment.get_comments, single_issue
+    # articles are created one after another to keep the order of the comments
+    failed = 0
+    for jiracomment in clist:
+        if is_comment_posted(state, jiracomment):
+            continue
+        with profiler.phase('transform'):
+            zarticle = yield 'call', prepare_comment, zicket['id'], jiracomment, jident, jatchments
+        try:
+            with profiler.phase('comments'):
+                zart = yield 'create', 'ticket_article', zarticle
+            logger.info('ticket_article created: %i', zart['id'])
+            metrics.inc('comments_total', status='migrated')
+        except Exception as zarticleexception:  # pylint: disable=broad-exception-caught
+            logger.error('unable to create zammad comment: %s', zarticleexception)
+            logger.error(zarticle)
+            logger.error(jiracomment.id)
+            metrics.inc('comments_total', status='failed')
+            failed += 1
+            if ledger.isEnabled():
+                return stop_issue(jident, f'comment {jiracomment.id}')
+            continue
+        # the ledger only advances after a article was created
+        yield 'call', ledger.articlePosted, jident, jatchments.get_used_ids(), jiracomment.id
+    # all attachements that are left over as internal comment
+    if not (state and state['leftovers_done']):
+        for attachment in jatchments.get_attachments():
+            logger.debug('handle remaining attachment %s', attachment.filename)
+            with profiler.phase('attachments'):
+                zarticle = yield (
+                    'call', j2z.attachment.jiraattachement2comment, zicket['id'], attachment
+                    )
+            try:
+                with profiler.phase('attachments'):
+                    zart = yield 'create', 'ticket_article', zarticle
+                logger.info('remaining attachments as ticket_article created: %i', zart['id'])
+            except Exception as zarticleexception:  # pylint: disable=broad-exception-caught
+                logger.error(
+                    'unable to create zammad article for attachment %s: %s',
+                    attachment.filename, zarticleexception
+                    )
+                logger.error(zarticle)
+                failed += 1
+                if ledger.isEnabled():
+                    return stop_issue(jident, f'attachment {attachment.filename}')
+                continue
+            jatchments.posted(attachment)
+            yield 'call', ledger.articlePosted, jident, jatchments.get_used_ids()
+        yield 'call', ledger.leftoversDone, jident
+    # labels + components -> tags: the tags are sent with the new ticket, so only
+    # the tags zammad did not apply (e.g. if new tags are not allowed) or that
+    # could not be sent (see j2z.tags.join_tags) are added - the tags of a
+    # resumed ticket are fetched
+    if not (state and state['tags_done']):
+        with profiler.phase('tags'):
+            tags = j2z.tags.get_tags(single_issue)
+            metrics.inc('tags_total', len(tags))
+            if applied is None:
+                applied = yield 'tags', zicket['id']
+            missing = j2z.tags.get_missing_tags(tags, applied)
+            if missing:
+                logger.info('ticket %i : add missing tags %s', zicket['id'], missing)
+                yield 'add_tags', zicket['id'], missing
+        yield 'call', ledger.tagsDone, jident
+    if failed:
+        logger.error(
+            'jira issue %s migrated as zammad ticket %i with %i failed articles',
+            jident, zicket['id'], failed
+            )
+        metrics.inc('issues_total', status='failed')
+        return False
+    yield 'call', ledger.issueDone, jident
+    metrics.inc('issues_total', status='migrated')
+    logger.warning('jira issue %s migrated as zammad ticket %i', jident, zicket['id'])
+    return True
@@ -0,0 +1,154 @@
+# vim: set fileencoding=utf-8
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4 smartindent ft=python
+# pylint: disable=fixme,invalid-name
+
+"""helper functions for jira 2 zammad migration : per issue profiling"""
+
+import os
+import re
+import json
+import time
+import heapq
+import logging
+import cProfile
+import threading
+import contextlib
+import contextvars
+
+logger = logging.getLogger(__name__)
+
+# phases of a issue in the order of the breakdown
+PHASES = ['fetch', 'transform', 'users', 'create', 'comments', 'attachments', 'tags']
+
+# the record of the issue processed by the current thread or task
+_CURRENT = contextvars.ContextVar('j2z_profiling_issue', default=None)
+
+
+class IssueProfiler:
+    """
+    profile each issue: the time spent in each phase, and a cProfile profile
+    of the top slowest issues written to the profile directory (<issue>.prof)
+    nested phases are not counted twice, e.g. the user resolution while
+    transforming a comment only counts as users
+    all methods are no-ops if the profiler is disabled
+    """
+    def __init__(self, directory=None, top=10):
+        """init profiler - disabled without a directory"""
+        self.directory = directory
+        self.top = top
+        self._slowest = []  # heap of (seconds, issue, phases, other)
+        self._lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            # the phases of a previous run are replaced
+            with open(os.path.join(directory, 'phases.jsonl'), 'w', encoding='utf-8'):
+                pass
+            logger.warning('profiling issues to %s (keeping the %i slowest)', directory, top)
+
+    def isEnabled(self):
+        """return enabled status"""
+        return self.directory is not None
+
+    def _filename(self, issue, ext):
+        """return the file for a issue"""
+        return os.path.join(self.directory, re.sub(r'[^A-Za-z0-9_.-]', '_', str(issue)) + ext)
+
+    @contextlib.contextmanager
+    def issue(self, issue, cprofile=True):
+        """
+        profile a issue - cprofile is only useful if the issue runs in a thread
+        of its own (not in the async engine)
+        """
+        if not self.directory:
+            yield
+            return
+        record = {'issue': str(issue), 'phases': dict.fromkeys(PHASES, 0.0), 'stack': []}
+        token = _CURRENT.set(record)
+        profiler = None
+        if cprofile:
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # another profiler is active in this interpreter
+                profiler = None
+        starttime = time.monotonic()
+        try:
+            yield
+        finally:
+            seconds = time.monotonic() - starttime
+            if profiler:
+                profiler.disable()
+            _CURRENT.reset(token)
+            self._finish(record, seconds, profiler)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """count the time of a phase of the current issue"""
+        record = _CURRENT.get()
+        if record is None:
+            yield
+            return
+        entry = {'start': time.monotonic(), 'children': 0.0}
+        record['stack'].append(entry)
+        try:
+            yield
+        finally:
+            record['stack'].pop()
+            elapsed = time.monotonic() - entry['start']
+            record['phases'][name] += elapsed - entry['children']
+            if record['stack']:
+                record['stack'][-1]['children'] += elapsed
+
+    def _finish(self, record, seconds, profiler):
+        """log the breakdown and keep the profile if the issue is one of the slowest"""
+        phases = record['phases']
+        other = max(seconds - sum(phases.values()), 0.0)
+        logger.info(
+            'profile %s: %.2fs - %s, other %.2fs',
+            record['issue'], seconds,
+            ', '.join(f'{name} {phases[name]:.2f}s' for name in PHASES), other
+            )
+        line = json.dumps({
+            'issue': record['issue'],
+            'seconds': round(seconds, 6),
+            'phases': {name: round(value, 6) for name, value in phases.items()},
+            'other': round(other, 6),
+            })
+        with self._lock:
+            with open(
+                    os.path.join(self.directory, 'phases.jsonl'), 'a', encoding='utf-8'
+                    ) as f:
+                f.write(line + '\n')
+            entry = (seconds, record['issue'], phases, other)
+            if len(self._slowest) < self.top:
+                heapq.heappush(self._slowest, entry)
+            elif seconds > self._slowest[0][0]:
+                evicted = heapq.heappushpop(self._slowest, entry)
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(self._filename(evicted[1], '.prof'))
+            else:
+                return
+            if profiler:
+                profiler.dump_stats(self._filename(record['issue'], '.prof'))
+
+    def report(self):
+        """log the slowest issues"""
+        if not self.directory:
+            return
+        with self._lock:
+            slowest = sorted(self._slowest, reverse=True)
+        for seconds, issue, phases, other in slowest:
+            logger.warning(
+                'slowest issue %s: %.2fs - %s, other %.2fs',
+                issue, seconds,
+                ', '.join(f'{name} {phases[name]:.2f}s' for name in PHASES if phases[name]),
+                other
+                )
+        logger.warning(
+            'per issue phases in %s, profiles of the slowest issues in %s/*.prof',
+            os.path.join(self.directory, 'phases.jsonl'), self.directory
+            )
+
+
+PROFILER = IssueProfiler()
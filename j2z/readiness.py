@@ -0,0 +1,182 @@
+# vim: set fileencoding=utf-8
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4 smartindent ft=python
+# pylint: disable=fixme,invalid-name
+
+"""helper functions for jira 2 zammad migration : search index readiness"""
+
+import logging
+import threading
+import time
+import j2z
+
+logger = logging.getLogger(__name__)
+
+# client connectors
+zammad = None
+mapping = None
+
+
+class IndexReadiness:  # pylint: disable=too-many-instance-attributes
+    """
+    verify in the background that new tickets and users can be found via search
+    new objects are registered as pending, and a single thread checks all
+    pending objects of a kind with one search query, using exponential backoff
+    until they show up or the timeout is reached
+    once a object is due, the objects due within the next delay are checked
+    with it, so the objects created in a row share one search
+    the observed indexing lag is kept as a metric instead of blocking the workers
+    """
+    KINDS = ['ticket', 'user']
+
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    def __init__(self, timeout=300.0, delay=0.5, maxdelay=30.0, batchsize=50):
+        """init readiness checks"""
+        self.timeout = timeout
+        self.delay = delay
+        self.maxdelay = maxdelay
+        self.batchsize = batchsize
+        self._pending = {kind: {} for kind in self.KINDS}
+        self._cond = threading.Condition()
+        self._thread = None
+        self.stats = {
+            kind: {'verified': 0, 'timeout': 0, 'lagsum': 0.0, 'lagmax': 0.0}
+            for kind in self.KINDS
+            }
+
+    def expect_ticket(self, issueidentstr, zicket):
+        """register a new ticket that should become searchable"""
+        self._expect('ticket', str(issueidentstr), zicket)
+
+    def expect_user(self, userident, zuser):
+        """register a new user that should become searchable"""
+        self._expect('user', userident.lower(), zuser)
+
+    def get_pending_user(self, userident):
+        """return a new user that can not be found via search yet or None"""
+        with self._cond:
+            entry = self._pending['user'].get(userident.lower())
+            return entry['obj'] if entry else None
+
+    def _expect(self, kind, ident, obj):
+        """register a pending object"""
+        now = time.monotonic()
+        with self._cond:
+            self._pending[kind][ident] = {
+                'obj': obj, 'since': now, 'due': now + self.delay, 'delay': self.delay
+                }
+            if not self._thread:
+                self._thread = threading.Thread(
+                    target=self._run, name='j2z-readiness', daemon=True
+                    )
+                self._thread.start()
+            self._cond.notify_all()
+
+    def _due(self):
+        """return (kind, idents due, None) or (None, [], seconds until the next is due)"""
+        now = time.monotonic()
+        nextdue = None
+        for kind, pending in self._pending.items():
+            if any(entry['due'] <= now for entry in pending.values()):
+                # coalesce the batch with the objects due soon
+                due = sorted(
+                    (entry['due'], ident) for ident, entry in pending.items()
+                    if entry['due'] <= now + self.delay
+                    )
+                return kind, [ident for _due, ident in due[:self.batchsize]], None
+            for entry in pending.values():
+                nextdue = entry['due'] if nextdue is None else min(nextdue, entry['due'])
+        return None, [], None if nextdue is None else max(nextdue - now, 0)
+
+    def _run(self):
+        """background verification loop"""
+        while True:
+            with self._cond:
+                kind, idents, wait = self._due()
+                while not idents:
+                    self._cond.wait(wait)
+                    kind, idents, wait = self._due()
+            try:
+                found = self._search(kind, idents)
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                logger.error('unable to check search index for %i %ss: %s', len(idents), kind, e)
+                found = set()
+            self._update(kind, idents, found)
+
+    def _search(self, kind, idents):
+        """return the idents that can be found using one search query"""
+        if kind == 'ticket':
+            field = mapping.get('issue', {}).get('key', {}).get('zammad', 'number')
+            query = '(' + ' OR '.join(f'{field}:"{ident}"' for ident in idents) + ')'
+            for ftag in mapping.get('tags', {}).get('default', []):
+                query += f' AND tags:{ftag}'
+            resource = zammad.ticket
+        else:
+            field = mapping.get('user', {}).get('key', {}).get('zammad', 'email')
+            query = ' OR '.join(f'{field}:"{ident}"' for ident in idents)
+            resource = zammad.user
+        # the search is not a exact match, so leave room for fuzzy results
+        pages = resource.search(query, filters={'per_page': max(100, 2 * len(idents))})
+        found = {str(obj.get(field, '')) for obj in pages}
+        if kind == 'user':
+            found = {ident.lower() for ident in found}
+        return found.intersection(idents)
+
+    def _update(self, kind, idents, found):
+        """record results and reschedule objects that are still missing"""
+        now = time.monotonic()
+        with self._cond:
+            for ident in idents:
+                entry = self._pending[kind].get(ident)
+                if not entry:
+                    continue
+                lag = now - entry['since']
+                if ident in found:
+                    del self._pending[kind][ident]
+                    self.stats[kind]['verified'] += 1
+                    j2z.metrics.METRICS.observe('index_lag_seconds', lag, kind=kind)
+                    self.stats[kind]['lagsum'] += lag
+                    self.stats[kind]['lagmax'] = max(self.stats[kind]['lagmax'], lag)
+                    logger.debug('%s %s searchable after %.1fs', kind, ident, lag)
+                elif lag > self.timeout:
+                    del self._pending[kind][ident]
+                    self.stats[kind]['timeout'] += 1
+                    logger.error(
+                        '%s %s still not found in the search index after %.0fs',
+                        kind, ident, lag
+                        )
+                else:
+                    entry['delay'] = min(entry['delay'] * 2, self.maxdelay)
+                    entry['due'] = now + entry['delay']
+            self._cond.notify_all()
+
+    def pending(self):
+        """return the number of objects not verified yet"""
+        with self._cond:
+            return sum(len(pending) for pending in self._pending.values())
+
+    def wait(self):
+        """block until all pending objects are verified or timed out"""
+        with self._cond:
+            if any(self._pending.values()):
+                logger.warning(
+                    'waiting for %i objects to appear in the search index ...',
+                    sum(len(pending) for pending in self._pending.values())
+                    )
+            while any(self._pending.values()):
+                self._cond.wait(5)
+
+    def report(self):
+        """log the indexing lag metrics"""
+        with self._cond:
+            for kind, stats in self.stats.items():
+                if not stats['verified'] and not stats['timeout']:
+                    continue
+                logger.warning(
+                    'search index %ss: %i verified (lag avg %.1fs, max %.1fs), %i timed out',
+                    kind, stats['verified'],
+                    stats['lagsum'] / max(stats['verified'], 1), stats['lagmax'],
+                    stats['timeout']
+                    )
+
+
+INDEX_READINESS = IndexReadiness()
@@ -15,8 +15,8 @@ jira = None
 zammad = None
 mapping = None
 
-def jira2zammad(zammad_id, jiraissue):
-    """map labels and componentes form a jira issue to zammad tags"""
+def get_tags(jiraissue):
+    """return the zammad tags for the labels and componentes of a jira issue"""
     tags = mapping.get('tags', {}).get('default', []).copy()
     for jc in jiraissue.get_field('components'):
         tag = jc.name.capitalize()
@@ -41,5 +41,16 @@ def jira2zammad(zammad_id, jiraissue):
         logger.debug('%s : label %s -> tag %s', jiraissue.key, label, tag)
     logger.debug('issue : %s ... final tags:', jiraissue.key)
     logger.debug(tags)
-    for tag in tags:
-        zammad.ticket_tag.add(zammad_id, tag)
+    return tags
+
+def join_tags(tags):
+    """
+    return the tags for the tags field of a new ticket - zammad splits it at
+    commas, so tags containing a comma are left to be added one by one
+    """
+    return ','.join(tag for tag in tags if ',' not in tag)
+
+def get_missing_tags(tags, existing):
+    """return the tags that are not in the existing tags of a ticket"""
+    existing = {tag.lower() for tag in existing}
+    return [tag for tag in tags if tag.lower() not in existing]
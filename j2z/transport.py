@@ -0,0 +1,376 @@
+# vim: set fileencoding=utf-8
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4 smartindent ft=python
+# pylint: disable=fixme,invalid-name
+
+"""helper functions for jira 2 zammad migration : http transport"""
+
+import re
+import math
+import time
+import logging
+import threading
+import urllib.parse
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import j2z
+
+logger = logging.getLogger(__name__)
+
+# requests with a larger body are not used to measure the latency
+LATENCY_MAXBODY = 1024 * 1024
+
+# ids in the path are not part of the endpoint name (but the jira api version)
+ENDPOINT_ID_PATTERN = re.compile(r'(?<!/api)/[0-9]+(?=/|$)')
+
+# jira attachment downloads end with the filename
+ENDPOINT_FILENAME_PATTERN = re.compile(r'^(/secure/attachment/:id)/.*$')
+
+def get_endpoint(method, url):
+    """return the endpoint of a request: method, host and path without ids and filenames"""
+    url = urllib.parse.urlsplit(url)
+    path = ENDPOINT_FILENAME_PATTERN.sub(r'\1', ENDPOINT_ID_PATTERN.sub('/:id', url.path))
+    return f'{method} {url.netloc}{path}'
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """raised instead of sending a request to a endpoint with a open circuit"""
+
+
+class TransportRetry(Retry):
+    """
+    retry idempotent requests on the configured status codes - and all
+    requests on 429, or on 503 with Retry-After, as the server refused to
+    process them
+    """
+    def is_retry(self, method, status_code, has_retry_after=False):
+        """check if a response should be retried"""
+        if self.status_forcelist and status_code in self.status_forcelist and (
+                status_code == 429 or (status_code == 503 and has_retry_after)):
+            return bool(self.total)
+        return super().is_retry(method, status_code, has_retry_after)
+
+
+class CircuitBreaker:
+    """
+    stop sending requests to a endpoint that keeps failing:
+    after `failures` failed requests in a row (after all retries) the circuit
+    opens and all requests fail at once for `cooldown` seconds, then a single
+    request may probe the endpoint again
+    failures=0 disables the circuit breaker
+    """
+    def __init__(self, failures=10, cooldown=60.0):
+        """init circuit breaker"""
+        self.failures = failures
+        self.cooldown = cooldown
+        self._state = {}
+        self._lock = threading.Lock()
+        self.stats = {'tripped': 0, 'rejected': 0}
+
+    def allow(self, endpoint):
+        """check if a request to a endpoint may be sent"""
+        if not self.failures:
+            return True
+        with self._lock:
+            state = self._state.get(endpoint)
+            if not state or state['opened'] is None:
+                return True
+            if time.monotonic() - state['opened'] >= self.cooldown:
+                # half open: the next request probes the endpoint, the others wait for it
+                state['opened'] = time.monotonic()
+                return True
+            self.stats['rejected'] += 1
+            return False
+
+    def record(self, endpoint, failed):
+        """record the result of a request"""
+        if not self.failures:
+            return
+        with self._lock:
+            state = self._state.setdefault(endpoint, {'failed': 0, 'opened': None})
+            if not failed:
+                if state['opened'] is not None:
+                    logger.warning('circuit for %s closed again', endpoint)
+                state['failed'] = 0
+                state['opened'] = None
+                return
+            state['failed'] += 1
+            if state['failed'] < self.failures:
+                return
+            if state['opened'] is None:
+                self.stats['tripped'] += 1
+                logger.error(
+                    'circuit for %s opened after %i failed requests in a row',
+                    endpoint, state['failed']
+                    )
+            state['opened'] = time.monotonic()
+
+
+class RateLimiter:  # pylint: disable=too-many-instance-attributes
+    """
+    adaptive client side rate limit for one backend (AIMD):
+    the number of concurrent requests grows by one after each window of
+    requests with a p95 latency below the target, and is halved on a higher
+    p95 latency or a 429 response - below one request it turns into pauses
+    between the requests (0.5 = the backend is busy half of the time)
+    maxrate is a fixed ceiling in requests per second (0 = no ceiling)
+    """
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    def __init__(self, name, maxrate=0, target=1.0, maxlimit=10, minlimit=0.1, window=10):
+        """init rate limiter"""
+        self.name = name
+        self.maxrate = maxrate
+        self.target = target
+        self.maxlimit = maxlimit
+        self.minlimit = minlimit
+        self.window = window
+        self.limit = float(max(1, maxlimit // 2))
+        self._inflight = 0
+        self._next = 0.0
+        self._latencies = []
+        self._decreased = 0.0
+        self._listeners = []
+        self._cond = threading.Condition()
+        self.stats = {
+            'requests': 0, 'increased': 0, 'decreased': 0, 'waited': 0.0,
+            'minlimit': self.limit
+            }
+
+    def try_acquire(self):
+        """
+        acquire a request slot without blocking: return 0 if acquired, else the
+        seconds to wait or None to wait for a running request
+        """
+        now = time.monotonic()
+        with self._cond:
+            if self._inflight >= max(self.limit, 1):
+                return None
+            if now < self._next:
+                return self._next - now
+            self._inflight += 1
+            self.stats['requests'] += 1
+            if self.maxrate:
+                self._next = max(now, self._next) + 1.0 / self.maxrate
+            return 0
+
+    def acquire(self):
+        """acquire a request slot"""
+        starttime = time.monotonic()
+        with self._cond:
+            wait = self.try_acquire()
+            while wait != 0:
+                self._cond.wait(wait)
+                wait = self.try_acquire()
+        self._waited(time.monotonic() - starttime)
+
+    def _waited(self, seconds):
+        """count the time spent waiting for a slot"""
+        if seconds > 0.001:
+            with self._cond:
+                self.stats['waited'] += seconds
+
+    def add_listener(self, callback):
+        """call callback after each released slot (to wake up waiting tasks)"""
+        with self._cond:
+            self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        """remove a listener"""
+        with self._cond:
+            self._listeners.remove(callback)
+
+    def release(self, latency=None, throttled=False):
+        """release a slot and adapt the limit to the latency or a 429 response"""
+        now = time.monotonic()
+        with self._cond:
+            self._inflight -= 1
+            if throttled:
+                self._decrease(now, '429 response')
+            elif latency is not None:
+                self._latencies.append(latency)
+                if len(self._latencies) >= self.window:
+                    # nearest rank: the 10th of 10 latencies, the 19th of 20
+                    rank = max(0, math.ceil(0.95 * len(self._latencies)) - 1)
+                    p95 = sorted(self._latencies)[rank]
+                    self._latencies = []
+                    if p95 > self.target:
+                        self._decrease(now, f'p95 latency {p95:.2f}s')
+                    elif self.limit < self.maxlimit:
+                        # below one request the pauses are halved
+                        self.limit = min(self.limit + min(self.limit, 1), self.maxlimit)
+                        self.stats['increased'] += 1
+            if self.limit < 1 and latency is not None:
+                # pause, so the backend is busy for limit of the time
+                self._next = max(self._next, now + latency * (1 / self.limit - 1))
+            self._cond.notify_all()
+            listeners = list(self._listeners)
+        for callback in listeners:
+            callback()
+
+    def _decrease(self, now, reason):
+        """halve the limit - once per target latency, as all running requests report"""
+        if now - self._decreased < self.target:
+            return
+        self._decreased = now
+        self._latencies = []
+        self.limit = max(self.limit / 2, self.minlimit)
+        self.stats['decreased'] += 1
+        self.stats['minlimit'] = min(self.stats['minlimit'], self.limit)
+        logger.info('rate limit %s : %s, limit %.2f', self.name, reason, self.limit)
+
+    def report(self):
+        """log the rate limit metrics"""
+        with self._cond:
+            logger.warning(
+                'rate limit %s: %i requests, limit %.2f (min %.2f), '
+                '%i increases, %i decreases, %.1fs waited',
+                self.name, self.stats['requests'], self.limit, self.stats['minlimit'],
+                self.stats['increased'], self.stats['decreased'], self.stats['waited']
+                )
+
+
+class TransportAdapter(HTTPAdapter):
+    """http adapter with retries, a default timeout and a circuit breaker"""
+    def __init__(self, transport):
+        """init the adapter with the settings of the transport"""
+        self.transport = transport
+        super().__init__(
+            pool_connections=transport.poolsize,
+            pool_maxsize=transport.poolsize,
+            max_retries=transport.retry
+            )
+
+    # pylint: disable-next=arguments-differ
+    def send(self, request, **kwargs):
+        """send a request unless the circuit of the endpoint is open"""
+        breaker = self.transport.breaker
+        endpoint = get_endpoint(request.method, request.url)
+        if not breaker.allow(endpoint):
+            raise CircuitOpenError(f'circuit open for {endpoint}', request=request)
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.transport.timeout
+        limiter = self.transport.get_limiter(request.url)
+        if limiter:
+            limiter.acquire()
+        # every acquired slot is released, without a latency on errors
+        release = {}
+        starttime = time.monotonic()
+        try:
+            response = super().send(request, **kwargs)
+            latency = time.monotonic() - starttime
+            j2z.metrics.METRICS.observe('request_seconds', latency, endpoint=endpoint)
+            throttled = response.status_code == 429
+            retries = getattr(response.raw, 'retries', None)
+            if retries and retries.history:
+                self.transport.count('retried', len(retries.history))
+                throttled = throttled or any(h.status == 429 for h in retries.history)
+            release = {
+                'latency': self.transport.get_latency(request, latency), 'throttled': throttled
+                }
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            self.transport.count('failed')
+            breaker.record(endpoint, True)
+            raise
+        finally:
+            if limiter:
+                limiter.release(**release)
+        breaker.record(endpoint, response.status_code >= 500)
+        # the body of a response that is not streamed is read by the session anyway
+        self.transport.local.response = None if kwargs.get('stream') else response
+        return response
+
+
+class Transport:  # pylint: disable=too-many-instance-attributes
+    """
+    shared http transport for the jira and zammad sessions, configured by the
+    transport section of the config:
+    retries with exponential backoff and jitter (respecting Retry-After),
+    connection pools sized to the workers, a default timeout and a circuit
+    breaker per endpoint
+    """
+    def __init__(self, config=None, poolsize=10):
+        """init transport"""
+        config = config or {}
+        self.retry = TransportRetry(
+            total=config.get('retries', 5),
+            backoff_factor=config.get('backoff', 0.5),
+            backoff_max=config.get('backoffmax', 60),
+            backoff_jitter=config.get('jitter', 0.5),
+            status_forcelist=config.get('statuses', [429, 502, 503, 504]),
+            allowed_methods=config.get('methods', Retry.DEFAULT_ALLOWED_METHODS),
+            respect_retry_after_header=True,
+            raise_on_status=False
+            )
+        breaker = config.get('breaker', {})
+        self.breaker = CircuitBreaker(breaker.get('failures', 10), breaker.get('cooldown', 60))
+        self.timeout = tuple(config.get('timeout', [10, 300]))
+        self.poolsize = poolsize
+        self.stats = {'retried': 0, 'failed': 0}
+        self._lock = threading.Lock()
+        # last response per thread
+        self.local = threading.local()
+        # adaptive rate limit per backend, disabled without a ratelimit config
+        self.ratelimit = config.get('ratelimit') or {}
+        if not self.ratelimit.get('enabled', True):
+            self.ratelimit = {}
+        self.limiters = {}
+
+    def count(self, key, num=1):
+        """count a metric"""
+        with self._lock:
+            self.stats[key] += num
+
+    def get_limiter(self, url):
+        """return the rate limiter of the backend of a url or None"""
+        if not self.ratelimit:
+            return None
+        backend = urllib.parse.urlsplit(url).netloc
+        with self._lock:
+            if backend not in self.limiters:
+                self.limiters[backend] = RateLimiter(
+                    backend,
+                    maxrate=self.ratelimit.get('maxrate', 0),
+                    target=self.ratelimit.get('target', 1.0),
+                    maxlimit=self.ratelimit.get('maxconcurrency', self.poolsize)
+                    )
+            return self.limiters[backend]
+
+    @staticmethod
+    def get_latency(request, seconds):
+        """
+        return the latency of a request for the rate limit - None for large
+        uploads, as their duration depends on the size, not on the load
+        """
+        if int(request.headers.get('Content-Length') or 0) > LATENCY_MAXBODY:
+            return None
+        return seconds
+
+    def get_response_size(self):
+        """
+        return the body size of the last response received by the current
+        thread, None if it was streamed
+        """
+        response = getattr(self.local, 'response', None)
+        if response is None:
+            return None
+        return len(response.content)
+
+    def mount(self, session):
+        """use the transport for all requests of a requests session"""
+        adapter = TransportAdapter(self)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+
+    def report(self):
+        """log the transport metrics"""
+        logger.warning(
+            'transport: %i retries, %i failed requests, circuit opened %i times '
+            '(%i requests rejected)',
+            self.stats['retried'], self.stats['failed'],
+            self.breaker.stats['tripped'], self.breaker.stats['rejected']
+            )
+        for limiter in self.limiters.values():
+            limiter.report()
+
+
+TRANSPORT = Transport()
@@ -6,9 +6,14 @@
 
 import os
 import logging
-import time
 import re
+import json
+import sqlite3
+import threading
+import time
+import concurrent.futures
 import yaml
+import j2z
 
 logger = logging.getLogger(__name__)
 
@@ -20,36 +25,93 @@ zuserdamage = None
 
 EMAIL_VALIDATE_PATTERN = r"^\S+@\S+\.\S+$"
 
+# per user locks, so parallel workers do not create or update the same user twice
+_USER_LOCKS = {}
+_USER_LOCKS_LOCK = threading.Lock()
+
+# per run memo of jira user key -> user ident, None for users without a valid ident
+_JIRA_USER_IDENTS = {}
+_JIRA_USER_IDENTS_LOCK = threading.Lock()
+JIRA_USER_IDENT_STATS = {'hit': 0, 'miss': 0}
+
 
 class ZUserDamage:
-    """store and revert changes made to user objects"""
+    """
+    store and revert changes made to user objects
+    every change is appended to a journal (damagefile + '.journal', one json
+    record per line, fsync'ed), which is replayed on top of the yaml damagefile;
+    compact writes the yaml damagefile and removes the journal
+    """
     def __init__(self, damagefile):
         """init ZUserDamage"""
         self.damagefile = damagefile
+        self.journalfile = self.journal(damagefile)
         self.damages = {}
+        self._lock = threading.RLock()
+        self._journal = None
         if os.path.exists(self.damagefile):
             with open(self.damagefile, 'r', encoding="utf-8") as df:
-                self.damages = yaml.safe_load(df)
+                self.damages = yaml.safe_load(df) or {}
                 logger.info('restored damages from %s', self.damagefile)
+        if os.path.exists(self.journalfile):
+            self._replay()
+            self.compact()
+
+    @staticmethod
+    def journal(damagefile):
+        """return the journal file of a damagefile"""
+        return damagefile + '.journal'
+
+    def _apply(self, record):
+        """apply a journal record"""
+        user_id = record['user_id']
+        if record.get('undone'):
+            self.damages.pop(user_id, None)
+            return
+        # we register just the initial change
+        damage = self.damages.setdefault(user_id, {})
+        for k, v in record['change'].items():
+            damage.setdefault(k, v)
+
+    def _replay(self):
+        """replay the journal"""
+        count = 0
+        with open(self.journalfile, 'r', encoding="utf-8") as jf:
+            for line in jf:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # a incomplete last record if we crashed while writing
+                    logger.warning('skip invalid record in %s: %s', self.journalfile, line.strip())
+                    continue
+                self._apply(record)
+                count += 1
+        logger.info('replayed %i changes from %s', count, self.journalfile)
+
+    def _append(self, records):
+        """append records to the journal"""
+        with self._lock:
+            if not self._journal:
+                self._journal = open(self.journalfile, 'a', encoding="utf-8")  # pylint: disable=consider-using-with
+            for record in records:
+                self._journal.write(json.dumps(record) + '\n')
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
 
     def registerDamage(self, user_id, change):
         """register a initial state of a user object"""
-        update = False
-        if not user_id in self.damages:
-            self.damages[user_id] = {}
-            update = True
-        # we register just the initial change
-        for k, v in change.items():
-            if k not in self.damages[user_id]:
-                update = True
-                self.damages[user_id][k] = v
-        if update:
-            self._writedamages()
-            logger.debug('changes for %s registered', user_id)
+        with self._lock:
+            # we register just the initial change
+            new = {k: v for k, v in change.items() if k not in self.damages.get(user_id, {})}
+            if user_id not in self.damages or new:
+                self._append([{'user_id': user_id, 'change': new}])
+                self.damages.setdefault(user_id, {}).update(new)
+                logger.debug('changes for %s registered', user_id)
 
     def _writedamages(self):
         """save the damage file"""
-        with open(self.damagefile, 'w', encoding="utf-8") as df:
+        tmpfile = self.damagefile + '.tmp'
+        with self._lock, open(tmpfile, 'w', encoding="utf-8") as df:
             damageyaml = yaml.dump(
                     self.damages,
                     indent=2,
@@ -59,62 +121,263 @@ class ZUserDamage:
                     allow_unicode=True
                 )
             df.write(damageyaml)
-            logger.debug('damagefile %s saved ...', self.damagefile)
+            df.flush()
+            os.fsync(df.fileno())
+        os.replace(tmpfile, self.damagefile)
+        logger.debug('damagefile %s saved ...', self.damagefile)
 
-    def undoDamage(self):
-        """revert changes"""
-        for uid in list(self.damages):
-            changes = self.damages[uid]
-            try:
-                zuser = zammad.user.find(uid)
-                for k, v in changes.items():
-                    zuser[k] = v
-                zammad.user.update(id=zuser['id'], params=zuser)
+    def _removejournal(self):
+        """close and remove the journal"""
+        with self._lock:
+            if self._journal:
+                self._journal.close()
+                self._journal = None
+            if os.path.exists(self.journalfile):
+                os.remove(self.journalfile)
+
+    def compact(self):
+        """write all changes to the yaml damagefile and start a new journal"""
+        with self._lock:
+            if self.damages:
+                self._writedamages()
+            elif os.path.exists(self.damagefile):
+                os.remove(self.damagefile)
+            self._removejournal()
+            logger.info('compacted damages of %i users to %s', len(self.damages), self.damagefile)
+
+    def _undo(self, uid):
+        """revert the changes of a user - return the user id or None"""
+        with self._lock:
+            changes = dict(self.damages[uid])
+        try:
+            # just the changed fields
+            zammad.user.update(id=uid, params=changes)
+        except Exception as e:
+            logger.error('user %s : unable to revert changes: %s', uid, e)
+            return None
+        # roles and active flag changed, so the cached user is outdated
+        USER_CACHE.invalidate(uid)
+        logger.debug('user %s : reverted changes', uid)
+        return uid
+
+    def _checkpoint(self, uids):
+        """record reverted users"""
+        if not uids:
+            return
+        with self._lock:
+            self._append([{'user_id': uid, 'undone': True} for uid in uids])
+            for uid in uids:
                 del self.damages[uid]
-                logger.debug('user %s : reverted changes', uid)
-            except Exception as e:
-                logger.error(e)
+
+    def undoDamage(self, workers=1, batchsize=100):
+        """revert changes"""
+        starttime = time.monotonic()
+        with self._lock:
+            uids = list(self.damages)
+        reverted = []
+        count = 0
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=max(workers, 1), thread_name_prefix='j2z-undo'
+                ) as executor:
+            for uid in executor.map(self._undo, uids):
+                if uid is None:
+                    continue
+                reverted.append(uid)
+                count += 1
+                if len(reverted) >= batchsize:
+                    self._checkpoint(reverted)
+                    reverted = []
+                    logger.info('reverted %i of %i users ...', count, len(uids))
+        self._checkpoint(reverted)
+        elapsed = time.monotonic() - starttime
+        logger.warning(
+            'reverted %i users in %.1fs (%.1f users/s), %i left',
+            count, elapsed, count / max(elapsed, 0.001), len(self.damages)
+            )
         if len(self.damages) == 0:
             logger.warning('removing clean damage file %s', self.damagefile)
-            os.remove(self.damagefile)
         else:
             logger.warning('saving leftover to damage file %s', self.damagefile)
-            self._writedamages()
+        self.compact()
 
 
 class UserCache:
-    """user cache"""
+    """
+    user cache - users are stored by the lowercased ident, and indexed by
+    zammad id to invalidate them
+    """
     def __init__(self, usecache=True):
         """init user cahce"""
         self._usecache = usecache
+        self._complete = False
         self._USERCACHE = {}
+        # zammad id -> lowercased idents
+        self._IDS = {}
+        self._lock = threading.Lock()
     def isEnabled(self):
         """return enabled status"""
         return self._usecache
+    def isComplete(self):
+        """return True if all zammad users were loaded, so a miss means a unknown user"""
+        return self._usecache and self._complete
+    def setComplete(self, complete):
+        """mark the cache as complete"""
+        self._complete = complete
     def setUsecache(self, usecache):
         """config usage"""
-        self._usecache = usecache
-        if not self._usecache:
-            self._USERCACHE = {}
+        with self._lock:
+            self._usecache = usecache
+            if not self._usecache:
+                self._USERCACHE = {}
+                self._IDS = {}
     def cache(self, userident, zuser):
         """store user in cache"""
+        self.cacheUsers([(userident, zuser)])
+    def cacheUsers(self, users):
+        """store (userident, zuser) pairs in cache"""
         if self._usecache:
-            if userident not in self._USERCACHE:
-                logger.debug('stored user %s', userident)
-            self._USERCACHE[userident] = zuser
+            with self._lock:
+                for userident, zuser in users:
+                    userident = userident.lower()
+                    previous = self._USERCACHE.get(userident)
+                    if previous is None:
+                        logger.debug('stored user %s', userident)
+                    elif previous['id'] != zuser['id']:
+                        self._IDS[previous['id']].discard(userident)
+                    self._USERCACHE[userident] = zuser
+                    self._IDS.setdefault(zuser['id'], set()).add(userident)
     def isCached(self, userident):
         """check if in cache"""
-        return userident in self._USERCACHE
+        with self._lock:
+            return userident.lower() in self._USERCACHE
     def getUser(self, userident):
         """return user from cache"""
         logger.debug('return %s from cache', userident)
-        return self._USERCACHE[userident]
+        with self._lock:
+            return self._USERCACHE[userident.lower()]
+    def invalidate(self, user_id):
+        """remove a user from the cache by zammad id"""
+        with self._lock:
+            # the user still exists in zammad
+            self._complete = False
+            for userident in self._IDS.pop(user_id, set()):
+                logger.debug('invalidated user %s', userident)
+                del self._USERCACHE[userident]
+
+
+class SQLiteUserCache(UserCache):
+    """
+    user cache persisted in a sqlite db, so it survives restarts and can be
+    shared by several migration processes
+    we store the zammad id, roles and the active flag of a user
+    inactive users are activated again when they are used, and users are
+    invalidated if undoDamage restores their roles and active flag
+    """
+    def __init__(self, dbfile, usecache=True):
+        """open or create the cache db"""
+        super().__init__(usecache)
+        self.dbfile = dbfile
+        self._db = sqlite3.connect(
+            dbfile,
+            timeout=60,
+            isolation_level=None,  # autocommit
+            check_same_thread=False
+            )
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS users ('
+            'userident TEXT PRIMARY KEY, id INTEGER NOT NULL, '
+            'role_ids TEXT NOT NULL, active INTEGER NOT NULL)'
+            )
+        self._db.execute('CREATE INDEX IF NOT EXISTS users_id ON users (id)')
+        logger.info('using user cache db %s', self.dbfile)
+    def setUsecache(self, usecache):
+        """config usage - the db will be kept"""
+        self._usecache = usecache
+    def cacheUsers(self, users):
+        """store (userident, zuser) pairs in cache - in a single transaction"""
+        if not self._usecache:
+            return
+        rows = [
+            (
+                userident.lower(), zuser['id'],
+                json.dumps(zuser.get('role_ids', [])), int(zuser.get('active', True))
+            )
+            for userident, zuser in users
+            ]
+        with self._lock:
+            self._db.execute('BEGIN')
+            try:
+                self._db.executemany(
+                    'INSERT INTO users (userident, id, role_ids, active) VALUES (?, ?, ?, ?) '
+                    'ON CONFLICT(userident) DO UPDATE SET '
+                    'id = excluded.id, role_ids = excluded.role_ids, active = excluded.active',
+                    rows
+                    )
+            except sqlite3.Error:
+                self._db.execute('ROLLBACK')
+                raise
+            self._db.execute('COMMIT')
+        logger.debug('stored %i users', len(rows))
+    def _get(self, userident):
+        """return the cached row for a user"""
+        with self._lock:
+            return self._db.execute(
+                'SELECT id, role_ids, active FROM users WHERE userident = ?',
+                (userident.lower(),)
+                ).fetchone()
+    def isCached(self, userident):
+        """check if in cache"""
+        if not self._usecache:
+            return False
+        return self._get(userident) is not None
+    def getUser(self, userident):
+        """return user from cache"""
+        logger.debug('return %s from cache db', userident)
+        row = self._get(userident)
+        if not row:
+            raise KeyError(userident)
+        return {
+            'id': row[0],
+            'role_ids': json.loads(row[1]),
+            'active': bool(row[2]),
+            mapping.get('user', {}).get('key', {}).get('zammad', 'email'): userident,
+            }
+    def invalidate(self, user_id):
+        """remove a user from the cache by zammad id"""
+        with self._lock:
+            self._complete = False
+            self._db.execute('DELETE FROM users WHERE id = ?', (user_id,))
 
 
 USER_CACHE = UserCache()
 
 
 def get_jira_user_ident(juser):
+    """return value to map user - memoized per jira user incl. users without a valid ident"""
+    jkey = getattr(juser, 'key', None) or getattr(juser, 'accountId', None)
+    if not jkey:
+        return _get_jira_user_ident(juser)
+    with _JIRA_USER_IDENTS_LOCK:
+        if jkey in _JIRA_USER_IDENTS:
+            JIRA_USER_IDENT_STATS['hit'] += 1
+            return _JIRA_USER_IDENTS[jkey]
+        JIRA_USER_IDENT_STATS['miss'] += 1
+    juserident = _get_jira_user_ident(juser)
+    with _JIRA_USER_IDENTS_LOCK:
+        _JIRA_USER_IDENTS[jkey] = juserident
+    return juserident
+
+def report_jira_user_idents():
+    """log the memo stats of get_jira_user_ident"""
+    with _JIRA_USER_IDENTS_LOCK:
+        logger.warning(
+            'jira user idents: %i hits, %i misses, %i without a valid ident',
+            JIRA_USER_IDENT_STATS['hit'], JIRA_USER_IDENT_STATS['miss'],
+            sum(1 for juserident in _JIRA_USER_IDENTS.values() if juserident is None)
+            )
+
+def _get_jira_user_ident(juser):
     """return value to map user"""
     juseridentfield = mapping.get('user', {}).get('key', {}).get('jira', 'emailAddress')
     if juseridentfield == 'emailAddress':
@@ -133,19 +396,43 @@ def get_jira_user_ident(juser):
     logger.warning('do not now how to handle juseridentfield %s', juseridentfield)
     return None
 
+def get_user_lock(userident):
+    """return the lock used to serialize the handling of a user"""
+    # zammad matches the userident case insensitive
+    lockkey = userident.lower()
+    with _USER_LOCKS_LOCK:
+        if lockkey not in _USER_LOCKS:
+            _USER_LOCKS[lockkey] = threading.RLock()
+        return _USER_LOCKS[lockkey]
+
 def ensure_zammad_user(userident, agent=False):
     """ensure we have a user id from zammad"""
     logger.debug('... userident: %s', userident)
     if not userident:
         # pylint: disable=broad-exception-raised
         raise Exception(f'unable to ensure zammad user with invalid userident: "{userident}"')
+    # workers may ask for the same (new) user at the same time
+    with j2z.profiling.PROFILER.phase('users'), get_user_lock(userident):
+        return _ensure_zammad_user(userident, agent)
+
+def _ensure_zammad_user(userident, agent):
+    """ensure we have a user id from zammad - caller must hold the user lock"""
     if USER_CACHE.isCached(userident):
         user = USER_CACHE.getUser(userident)
+        if not user['active'] or agent:
+            user = ensure_user_active(userident, user)
+            if agent:
+                user = ensure_user_agent(userident, user)
+            USER_CACHE.cache(userident, user)
+        return user
+    # a new user that can not be found via search yet
+    user = j2z.readiness.INDEX_READINESS.get_pending_user(userident)
+    if user:
         if agent:
             user = ensure_user_agent(userident, user)
-            USER_CACHE.cache(userident, user)
         return user
-    if get_zammad_user_count(userident) == 0:
+    # a complete cache already knows all existing users
+    if USER_CACHE.isComplete() or get_zammad_user_count(userident) == 0:
         nuser = create_zammad_user(userident, agent)
         zuserdamage.registerDamage(nuser['id'], {'role_ids': [], 'active': False})
         USER_CACHE.cache(userident, nuser)
@@ -162,12 +449,11 @@ def create_zammad_user(userident, agent):
     if agent:
         zuser_data['role_ids'] = mapping.get('user', {}).get('agent_role_keys', [2])
     nuster = zammad.user.create(zuser_data)
-    # new objects require some time until the can be found, so we have to be patient
+    j2z.metrics.METRICS.inc('users_created_total')
+    # new objects require some time until the can be found
     # but if we use the user cache, this is not necessary
     if not USER_CACHE.isEnabled():
-        while get_zammad_user_count(userident) == 0:
-            logger.debug('waiting for user %s to appear ...', userident)
-            time.sleep(1)
+        j2z.readiness.INDEX_READINESS.expect_user(userident, nuster)
     return nuster
 
 def get_zammad_user_exactmatch(userident):
@@ -216,6 +502,43 @@ def ensure_user_agent(userident, user):
         zammad.user.update(id=user['id'], params=user)
     return user
 
+def ensure_user_active(userident, user):
+    """activate a existing user if required"""
+    if not user['active']:
+        logger.debug('user %s (%i) will be activated!', userident, user['id'])
+        zuserdamage.registerDamage(user['id'], {'active': False})
+        user['active'] = True
+        zammad.user.update(id=user['id'], params=user)
+    return user
+
+def preload_users(perpage=100):
+    """
+    fill the user cache with all zammad users using the paginated user listing
+    afterwards a cache miss means the user does not exist yet, so no search is required
+    """
+    if not USER_CACHE.isEnabled():
+        logger.warning('user cache is disabled, skip preloading users')
+        return 0
+    starttime = time.monotonic()
+    useridentfield = mapping.get('user', {}).get('key', {}).get('zammad', 'email')
+    count = 0
+    user_pages = zammad.user.all(filters={'per_page': perpage, 'expand': 'false'})
+    while True:
+        # one transaction per page for the cache db
+        users = [
+            (str(user[useridentfield]), user) for user in user_pages if user.get(useridentfield)
+            ]
+        USER_CACHE.cacheUsers(users)
+        count += len(users)
+        if user_pages.is_last_page():
+            break
+        user_pages = user_pages.next_page()
+    USER_CACHE.setComplete(True)
+    logger.warning(
+        'preloaded %i zammad users in %.1fs', count, time.monotonic() - starttime
+        )
+    return count
+
 def get_zammad_user(userident, agent=False):
     """try to get a uniq user from zammad by email"""
     logger.debug('search zammad user %s ...', userident)
@@ -226,11 +549,7 @@ def get_zammad_user(userident, agent=False):
         for user in user_pages:
             if len(user_pages) > 1:
                 logger.debug('returning first match for user %s!', userident)
-            if not user['active']:
-                logger.debug('user %s (%i) will be activated!', userident, user['id'])
-                zuserdamage.registerDamage(user['id'], {'active': False})
-                user['active'] = True
-                zammad.user.update(id=user['id'], params=user)
+            user = ensure_user_active(userident, user)
             if agent:
                 user = ensure_user_agent(userident, user)
             logger.debug('... found user id %i for %s', user['id'], userident)
@@ -5,9 +5,10 @@
 
 import os
 import sys
+import atexit
 import logging
-import time
 import argparse
+import concurrent.futures
 import urllib3
 import hiyapyco
 
@@ -30,6 +31,13 @@ import j2z.comment
 import j2z.tags
 import j2z.attachment
 import j2z.issuelink
+import j2z.migrate
+import j2z.aio
+import j2z.readiness
+import j2z.ledger
+import j2z.transport
+import j2z.metrics
+import j2z.profiling
 
 urllib3.disable_warnings()
 
@@ -76,6 +84,13 @@ parser.add_argument(
     default='/var/tmp/jira2zammad-damage-done.yml'
     )
 
+parser.add_argument(
+    '--linkgraph',
+    type=str,
+    help='file to keep the jira issue links of all runs, the links of earlier runs are applied '
+         'for the issues in the ledger - without only the links of this run are applied ... ',
+    )
+
 parser.add_argument(
     '-D','--continuedamagefile',
     help='continue using a existing damagefile',
@@ -88,6 +103,12 @@ parser.add_argument(
     action="store_true"
     )
 
+parser.add_argument(
+    '--undoworkers',
+    type=int, default=4,
+    help='number of users to revert in parallel ... ',
+    )
+
 parser.add_argument(
     '-j','--jiraissue',
     nargs='+',
@@ -98,13 +119,13 @@ parser.add_argument(
 parser.add_argument(
     '-s','--startat',
     type=int, default=0,
-    help='start at jira search page ... ',
+    help='start at this offset of the jira search ... ',
     )
 
 parser.add_argument(
     '-m','--maxresults',
     type=int, default=50,
-    help='max results per jira search page ... ',
+    help='initial max results per jira search page, adapted to the response time and size ... ',
     )
 
 parser.add_argument(
@@ -113,6 +134,134 @@ parser.add_argument(
     help='disable using the internal cache for users ... ',
     )
 
+parser.add_argument(
+    '--usercachedb',
+    type=str,
+    help='persist the user cache in this sqlite db (can be shared by several processes) ... ',
+    )
+
+parser.add_argument(
+    '-P','--preloadusers',
+    action="store_true",
+    help='load all zammad users into the user cache, so no user searches are required ... ',
+    )
+
+parser.add_argument(
+    '--embedcomments',
+    action="store_true",
+    help='take the comments from the jira issue search instead of one request per issue ... ',
+    )
+
+parser.add_argument(
+    '--progressinterval',
+    type=int, default=60,
+    help='log the progress (throughput and ETA) every n seconds, 0 disables it ... ',
+    )
+
+parser.add_argument(
+    '--metricsfile',
+    type=str,
+    help='write the metrics to this prometheus node-exporter textfile (*.prom) ... ',
+    )
+
+parser.add_argument(
+    '--summaryfile',
+    type=str,
+    help='write all metrics as json to this file at the end ... ',
+    )
+
+parser.add_argument(
+    '--profile',
+    type=str,
+    help='profile each issue, keep the profiles of the slowest issues in this directory ... ',
+    )
+
+parser.add_argument(
+    '--profiletop',
+    type=int, default=10,
+    help='number of the slowest issues to keep the profiles of ... ',
+    )
+
+parser.add_argument(
+    '--ledger',
+    type=str,
+    help='sqlite db to record the state of each issue, so issues resume where they stopped ... ',
+    )
+
+parser.add_argument(
+    '-I','--ticketindex',
+    action="store_true",
+    help='prefetch a local index of the migrated tickets instead of searching for each issue ... ',
+    )
+
+parser.add_argument(
+    '--readinesstimeout',
+    type=int, default=300,
+    help='max. seconds to wait for new tickets and users to appear in the search index ... ',
+    )
+
+parser.add_argument(
+    '--spoolsize',
+    type=int, default=16,
+    help='attachments larger than this many MB are spooled to disk instead of memory ... ',
+    )
+
+parser.add_argument(
+    '--attachmentcache',
+    type=str,
+    help='cache the jira attachments in this directory ... ',
+    )
+
+parser.add_argument(
+    '--attachmentcachesize',
+    type=int, default=10240,
+    help='max. size of the attachment cache in MB ... ',
+    )
+
+parser.add_argument(
+    '--prefetch',
+    type=int, default=0,
+    help='download the attachments of a issue in the background using this many threads ... ',
+    )
+
+parser.add_argument(
+    '--prefetchbudget',
+    type=int, default=64,
+    help='max. MB of attachments prefetched per issue ... ',
+    )
+
+parser.add_argument(
+    '--prefetchlookahead',
+    action="store_true",
+    help='prefetch the attachments of the next issues waiting for a worker too, '
+         'requires --ledger or --ticketindex to skip migrated issues ... ',
+    )
+
+parser.add_argument(
+    '-w','--workers',
+    type=int, default=1,
+    help='number of issues to migrate in parallel using the sync engine ... ',
+    )
+
+parser.add_argument(
+    '-e','--engine',
+    type=str, default='sync',
+    choices=['sync', 'async'],
+    help='migration engine: sync (threads) or async (asyncio + aiohttp) ... ',
+    )
+
+parser.add_argument(
+    '--asynclimit',
+    type=int, default=100,
+    help='max. issues and zammad requests in flight using the async engine ... ',
+    )
+
+parser.add_argument(
+    '--asyncthreads',
+    type=int, default=32,
+    help='threads for the blocking steps of the async engine (jira, users, attachments) ... ',
+    )
+
 args = parser.parse_args()
 
 # args.config will be a list of lists, so flatten with
@@ -125,19 +274,34 @@ config = hiyapyco.load(
     usedefaultyamlloader=True,
     loglevel=logging.ERROR)
 
-if os.path.exists(args.damagefile) and not args.continuedamagefile:
-    sys.exit(f'damagefile {args.damagefile} exists!')
+if args.engine == 'async' and not j2z.aio.aiohttp:
+    sys.exit('the async engine requires aiohttp (pip install aiohttp)')
+
+for damagefile in [args.damagefile, j2z.user.ZUserDamage.journal(args.damagefile)]:
+    if os.path.exists(damagefile) and not args.continuedamagefile:
+        sys.exit(f'damagefile {damagefile} exists!')
 
 zuserdamage = j2z.user.zuserdamage = j2z.user.ZUserDamage(args.damagefile)
 
+# shared http transport: retries, connection pools and circuit breaker
+j2z.transport.TRANSPORT = j2z.transport.Transport(
+    config.get('transport'),
+    poolsize=max(
+        args.workers, args.undoworkers, args.prefetch,
+        args.asyncthreads if args.engine == 'async' else 0
+        ) + 2
+    )
+
 # init jira
 logger.info('jira connection %s ...', config['jira']['baseurl'])
 jira = JIRA(
     config['jira']['baseurl'],
     basic_auth=(config['jira']['authuser'],
     config['jira']['authpass']),
-    options=config['jira'].get('options', None)
+    options=config['jira'].get('options', None),
+    max_retries=0  # retries are handled by the transport
     )
+j2z.transport.TRANSPORT.mount(jira._session)  # pylint: disable=protected-access
 
 # init zammad
 logger.info('zammad connection %s ...', config['zammad']['baseurl'])
@@ -148,6 +312,7 @@ zammad = ZammadAPI(
     http_token=config['zammad'].get('authtoken', None),
     )
 zammad.session.verify = config['zammad'].get('verify', True)  # ssl verification
+j2z.transport.TRANSPORT.mount(zammad.session)
 
 logger.info('... connections established - ready to process issues')
 
@@ -156,10 +321,38 @@ logger.info('... connections established - ready to process issues')
 j2z.issue.jira = j2z.user.jira = j2z.comment.jira = j2z.tags.jira = j2z.issuelink.jira =  jira
 j2z.issue.zammad = j2z.user.zammad = j2z.comment.zammad = j2z.tags.zammad = j2z.issuelink.zammad = j2z.attachment.zammad = zammad  # pylint: disable=line-too-long
 j2z.issue.mapping = j2z.user.mapping = j2z.comment.mapping = j2z.tags.mapping = j2z.attachment.mapping = config['mapping']  # pylint: disable=line-too-long
-j2z.issuelink.config = config
+j2z.issuelink.config = j2z.migrate.config = j2z.aio.config = config
+j2z.readiness.zammad = zammad
+j2z.readiness.mapping = config['mapping']
+j2z.readiness.INDEX_READINESS.timeout = args.readinesstimeout
+j2z.attachment.SPOOLSIZE = args.spoolsize * 1024 * 1024
+j2z.comment.EMBEDDED_COMMENTS = args.embedcomments
+if args.attachmentcache:
+    j2z.attachment.ATTACHMENT_CACHE = j2z.attachment.AttachmentCache(
+        args.attachmentcache, args.attachmentcachesize * 1024 * 1024
+        )
+if args.prefetch:
+    j2z.attachment.PREFETCHER = j2z.attachment.AttachmentPrefetcher(
+        args.prefetch, args.prefetchbudget * 1024 * 1024
+        )
+j2z.migrate.jira = j2z.aio.jira = jira
+j2z.migrate.zammad = j2z.aio.zammad = zammad
 
+if args.usercachedb:
+    j2z.user.USER_CACHE = j2z.user.SQLiteUserCache(args.usercachedb)
 if args.nousercache:
     j2z.user.USER_CACHE.setUsecache(False)
+if args.preloadusers:
+    logger.warning('preloading zammad users ...')
+    j2z.user.preload_users()
+
+j2z.issuelink.LINK_GRAPH = j2z.issuelink.LinkGraph(args.linkgraph)
+j2z.ledger.LEDGER = j2z.ledger.IssueLedger(args.ledger)
+j2z.profiling.PROFILER = j2z.profiling.IssueProfiler(args.profile, args.profiletop)
+
+if args.ticketindex:
+    logger.warning('loading ticket index ...')
+    j2z.issue.TICKET_INDEX.load(config['mapping']['issue']['key'].get('zammad', 'number'))
 
 # fetch issues
 pjql = 'project = {} ORDER BY key ASC'.format(config['jira']['project'])  # pylint: disable=consider-using-f-string
@@ -168,171 +361,96 @@ if args.jiraissue:
     jirraissuesjqllist = '({})'.format(','.join(jirraissues))  # pylint: disable=consider-using-f-string,invalid-name
     pjql = f'key in {jirraissuesjqllist} ORDER BY key ASC'
     args.maxresults = 1
-IS_LAST = False
-START_AT = args.startat
-MAX_RESULTS = args.maxresults
+
+def check_migrate_results(futures):
+    """log unexpected errors raised by a worker"""
+    for future in futures:
+        if future.exception():
+            logger.error('unexpected error in issue worker: %s', future.exception())
+
+def stop_metrics():
+    """write the final metrics and the summary - on errors too"""
+    j2z.metrics.METRICS.stop()
+    if args.summaryfile:
+        j2z.metrics.METRICS.write_summary(args.summaryfile)
+
 logger.info('jql: %s', pjql)
-while not IS_LAST:
-    logger.warning('loop %i issue starting from %i', MAX_RESULTS, START_AT)
-    # pylint: disable=invalid-name
-    resList = jira.search_issues(
-        jql_str=pjql,
-        startAt=START_AT,
-        maxResults=MAX_RESULTS,
-        expand='renderedFields'
+j2z.metrics.METRICS.start(args.progressinterval, args.metricsfile)
+atexit.register(stop_metrics)
+if args.engine == 'async':
+    j2z.aio.migrate(
+        j2z.issue.search_jira_issues(pjql, args.startat, args.maxresults),
+        threads=args.asyncthreads,
+        limit=args.asynclimit,
+        lookahead=args.prefetchlookahead
         )
-    # isLast : Note that this property is not returned for all operations.
-    if not resList:
-        IS_LAST = True
-        logger.info('reached end of issue loop!')
-        break
-    IS_LAST = resList.isLast
-    START_AT = START_AT + MAX_RESULTS
-    for single_issue in resList:  # pylint: disable=not-an-iterable
-        logger.info('parse jira issue %s : %s', single_issue.key, single_issue.fields.summary)
-        jidentfield = config['mapping']['issue']['key'].get('jira', 'id')
-        jident = j2z.issue.get_jira_issue_identifier(single_issue, jidentfield)
-        zidentfield = config['mapping']['issue']['key'].get('zammad', 'number')
-        logger.debug(
-            'jidentfield: %s; jident: %s; zidentfield: %s',
-            jidentfield, jident, zidentfield
-            )
-        if j2z.issue.get_zammad_issue_count(jident, issueidentfield=zidentfield) > 0:
-            logger.warning(
-                'jira issue %s=%s already exists in zammad (%s=%s)',
-                jidentfield, jident, zidentfield, jident
-                )
-            continue
-        try:
-            zicket_data = j2z.issue.jira2zammad(single_issue)
-        except Exception as zicketdataexception:  # pylint: disable=broad-exception-caught
-            #import traceback
-            #traceback.print_exc()
-            logger.error(
-                'unable to translate data from jira 2 zammad for %s : %s',
-                jident, zicketdataexception
-                )
-            continue
-        # attachments:
-        # the main problem here is, that attachments in zammad are bound to articles
-        # and in jira to issues with optional occurence in comments as link or inline
-        jatchments = j2z.attachment.JAtchments(
-            single_issue.fields.attachment,
-            single_issue.key,
-            config
+else:
+    # run the per issue pipeline in parallel if requested
+    executor = None
+    pending = set()
+    if args.workers > 1:
+        logger.info('using %i workers', args.workers)
+        executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=args.workers,
+            thread_name_prefix='j2z-worker'
             )
-        # attachments can be in the description too
-        if zicket_data.get('article', {}).get('body'):
-            attamatched, attachments, body = jatchments.check_attachments_in_article(
-                    zicket_data['article']['body'],
-                    single_issue.get_field('reporter')
-                )
-            if attamatched:
-                logger.info(
-                    'issue %s : updated description because of attachments (%i)',
-                    jident, len(attachments)
-                    )
-                zicket_data['article']['body'] = body
-                for attachment in attachments:
-                    zattchment = j2z.attachment.jira2zammad(attachment)
-                    zicket_data['article']['attachments'].append(zattchment)
-        # TODO: mention in comments and description
-        # <a class="user-hover" href="https://<JIRA>/secure/ViewProfile.jspa?name=<LOGIN>"><SNAME, FNAME></a>  # pylint: disable=line-too-long
-        # <a href=\"https://<ZAMMAD>/#user/profile/<ID>\" data-mention-user-id=\"<ID>\"><FNAME SNAME></a>      # pylint: disable=line-too-long
-        logger.debug('zicket_data ...')
-        logger.debug(zicket_data)
-        try:
-            zicket = zammad.ticket.create(zicket_data)
-            logger.warning('jira issue %s created as zammad ticket %i ...', jident, zicket['id'])
-            # in order to find the matching ticket we need to appyl the tags if configured
-            for identtag in config['mapping'].get('tags', {}).get('default', []):
-                zammad.ticket_tag.add(zicket['id'], identtag)
-            while j2z.issue.get_zammad_issue_count(jident, issueidentfield=zidentfield) == 0:
-                logger.debug('waiting for new zammad ticket %s to appear ...', jident)
-                time.sleep(1)
-        except Exception as zicketexception:  # pylint: disable=broad-exception-caught
-            logger.error('unable to create zammad issue for %s : %s', jident, zicketexception)
-            logger.error(zicket_data)
-            continue
-        clist = jira.comments(single_issue.id, 'renderedBody,properties')
-        for jiracomment in clist:
-            logger.debug('... jiracomment %s', jiracomment)
-            zarticle = {}
-            zarticle = j2z.comment.jira2zammad(zicket['id'], jiracomment)
-            # attachments in comment
-            if zarticle.get('body'):
-                attamatched = False
-                attamatched, attachments, body = jatchments.check_attachments_in_article(zarticle['body'], jiracomment.author)  # pylint: disable=line-too-long
-                if attamatched:
-                    logger.info(
-                        'issue %s : updated comment "%s ..." because of attachments (%i)',
-                        jident, body[:10], len(attachments)
+    for resList in j2z.issue.search_jira_issues(pjql, args.startat, args.maxresults):
+        for num, single_issue in enumerate(resList):
+            if not executor:
+                if args.prefetchlookahead and num + 1 < len(resList):
+                    j2z.attachment.PREFETCHER.prefetch(
+                        j2z.migrate.get_lookahead_attachments(resList[num + 1])
                         )
-                    zarticle['body'] = body
-                    for attachment in attachments:
-                        logger.debug(
-                            'issue %s : comment "%s ..." - append attachment %s',
-                            jident, body[:10], attachment.filename
-                            )
-                        zattchment = j2z.attachment.jira2zammad(attachment)
-                        zarticle['attachments'].append(zattchment)
-            #logger.debug('zarticle updated ... attachments: %s', zarticle.get('attachments'))
-            #logger.debug('zarticle ...')
-            #logger.debug(zarticle)
-            try:
-                zart = zammad.ticket_article.create(zarticle)
-                logger.info('ticket_article created: %i', zart['id'])
-            except Exception as zarticleexception:  # pylint: disable=broad-exception-caught
-                logger.error('unable to create zammad comment: %s', zarticleexception)
-                logger.error(zarticle)
-                logger.error(jiracomment.id)
-        # all attachements that are left over as internal comment
-        for attachment in jatchments.get_attachments():
-            logger.debug('handle remaining attachment %s', attachment.filename)
-            zarticle = j2z.attachment.jiraattachement2comment(zicket['id'], attachment)
-            try:
-                zart = zammad.ticket_article.create(zarticle)
-                logger.info('remaining attachments as ticket_article created: %i', zart['id'])
-            except Exception as zarticleexception:  # pylint: disable=broad-exception-caught
-                logger.error(
-                    'unable to create zammad article for attachment %s: %s',
-                    attachment.filename, zarticleexception
+                j2z.migrate.migrate_issue(single_issue)
+                continue
+            # keep a bounded number of issues queued for the workers
+            while len(pending) >= 2 * args.workers:
+                done, pending = concurrent.futures.wait(
+                    pending,
+                    return_when=concurrent.futures.FIRST_COMPLETED
+                    )
+                check_migrate_results(done)
+            if args.prefetchlookahead:
+                j2z.attachment.PREFETCHER.prefetch(
+                    j2z.migrate.get_lookahead_attachments(single_issue)
                     )
-                logger.error(zarticle)
-        # labels + components -> tags
-        j2z.tags.jira2zammad(zicket['id'], single_issue)
-        logger.warning('jira issue %s migrated as zammad ticket %i', jident, zicket['id'])
+            pending.add(executor.submit(j2z.migrate.migrate_issue, single_issue))
+    if executor:
+        done, pending = concurrent.futures.wait(pending)
+        check_migrate_results(done)
+        executor.shutdown()
+
+# all new tickets must be searchable before we can link them
+j2z.readiness.INDEX_READINESS.wait()
+j2z.readiness.INDEX_READINESS.report()
+j2z.user.report_jira_user_idents()
+j2z.attachment.ATTACHMENT_CACHE.report()
+j2z.attachment.PREFETCHER.report()
 
 # postprocessing: issue links
 # issue links can only be processed after all issues are imported
-IS_LAST = False
-START_AT = args.startat
-MAX_RESULTS = args.maxresults
 logger.warning('start postprocessing: issuelinks ...')
-while not IS_LAST:
-    logger.warning('issuelinks : loop %i issues starting from %i', MAX_RESULTS, START_AT)
-    # pylint: disable=invalid-name
-    resList = jira.search_issues(
-        jql_str=pjql,
-        startAt=START_AT,
-        maxResults=MAX_RESULTS,
-        expand='renderedFields'
-        )
-    # isLast : Note that this property is not returned for all operations.
-    if not resList:
-        IS_LAST = True
-        logger.info('issuelinks : reached end of issue loop!')
-        break
-    IS_LAST = resList.isLast
-    START_AT = START_AT + MAX_RESULTS
-    for single_issue in resList:  # pylint: disable=not-an-iterable
-        j2z.issuelink.jira2zammad(single_issue)
-logger.warning('postprocessing: issuelinks done')
+# the links of all issues of this run were recorded during the migration (the
+# skipped issues too), the links of earlier runs only for the issues in the ledger
+linkstats = j2z.issuelink.LinkEngine(args.workers).apply(
+    j2z.issuelink.LINK_GRAPH.sources(j2z.ledger.LEDGER.idents())
+    )
+logger.warning(
+    'postprocessing: issuelinks done - %i links: %i created, %i existing, %i failed, %i unresolved',
+    linkstats['edges'], linkstats['created'], linkstats['existing'],
+    linkstats['failed'], linkstats['unresolved']
+    )
 
 
 # revert the changes we have made to users
 if not args.noundodamage:
     logger.warning('postprocessing: start undoDamage ...')
-    zuserdamage.undoDamage()
-
+    zuserdamage.undoDamage(args.undoworkers)
+else:
+    zuserdamage.compact()
+
+j2z.transport.TRANSPORT.report()
+j2z.profiling.PROFILER.report()
+atexit.unregister(stop_metrics)
+stop_metrics()
 logger.warning('all done! abba zaba go-zoom babbette baboon')
@@ -0,0 +1,67 @@
+# vim: set fileencoding=utf-8
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4 smartindent ft=python
+# pylint: disable=fixme,invalid-name
+
+"""tests for jira 2 zammad migration : issue / ticket attachments"""
+
+import os
+import types
+import tempfile
+import unittest
+import j2z.attachment
+
+
+class AttachmentCacheTest(unittest.TestCase):
+    """lru eviction of j2z.attachment.AttachmentCache"""
+    def setUp(self):
+        """cache of 10 blobs of 100 bytes"""
+        self.tmpdir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.cache = j2z.attachment.AttachmentCache(self.tmpdir.name, maxsize=1000, lowwater=0.5)
+
+    def tearDown(self):
+        """remove the cache"""
+        self.tmpdir.cleanup()
+
+    def put(self, attachment_id, content):
+        """store a attachment"""
+        attachment = types.SimpleNamespace(id=attachment_id, size=len(content))
+        self.cache.put(attachment, [content]).fileobj.close()
+        return attachment
+
+    def get(self, attachment):
+        """return the content of a cached attachment or None"""
+        data = self.cache.get(attachment)
+        if data is None:
+            return None
+        with data.fileobj:
+            return data.read()
+
+    def test_evict_to_low_water_mark(self):
+        """the least recently used blobs and their ids are removed"""
+        attachments = [self.put(i, bytes([i]) * 100) for i in range(10)]
+        # a duplicate and a hit keep the first two blobs
+        self.put(100, bytes([0]) * 100)
+        self.assertEqual(self.get(attachments[1]), bytes([1]) * 100)
+        self.assertEqual(self.cache.stats['evicted'], 0)
+        self.put(10, bytes([10]) * 100)
+        self.assertEqual(self.cache.stats['evicted'], 6)
+        kept = [i for i, attachment in enumerate(attachments) if self.get(attachment)]
+        self.assertEqual(kept, [0, 1, 8, 9])
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(self.tmpdir.name, 'ids')), key=int),
+            ['0', '1', '8', '9', '10', '100']
+            )
+        self.assertEqual(len(os.listdir(os.path.join(self.tmpdir.name, 'blobs'))), 5)
+
+    def test_reload(self):
+        """a new cache finds the blobs and removes ids without blob"""
+        attachment = self.put(1, b'x' * 100)
+        with open(os.path.join(self.tmpdir.name, 'ids', '2'), 'w', encoding='utf-8') as idfile:
+            idfile.write('0' * 64)
+        self.cache = j2z.attachment.AttachmentCache(self.tmpdir.name, maxsize=1000)
+        self.assertEqual(self.get(attachment), b'x' * 100)
+        self.assertEqual(os.listdir(os.path.join(self.tmpdir.name, 'ids')), ['1'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+# vim: set fileencoding=utf-8
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4 smartindent ft=python
+# pylint: disable=fixme,invalid-name
+
+"""tests for jira 2 zammad migration : issue / ticket comments"""
+
+import types
+import unittest
+import j2z.comment
+
+
+def get_issue(*comments):
+    """return a search result issue with the embedded comments"""
+    return types.SimpleNamespace(key='X-1', raw={
+        'fields': {'comment': {'total': len(comments), 'comments': list(comments)}},
+        })
+
+
+class EmbeddedCommentsTest(unittest.TestCase):
+    """j2z.comment.get_embedded_comments"""
+    def setUp(self):
+        """jira connector for the comment resources"""
+        self.jira = j2z.comment.jira
+        j2z.comment.jira = types.SimpleNamespace(
+            _options={'server': 'https://jira.example.org', 'rest_path': 'api',
+                      'rest_api_version': '2', 'agile_rest_path': 'agile'},
+            _session=None
+            )
+
+    def tearDown(self):
+        """restore the connector"""
+        j2z.comment.jira = self.jira
+
+    def test_visibility(self):
+        """embedded comments with the service desk visibility are used"""
+        comments = j2z.comment.get_embedded_comments(get_issue(
+            {'id': '1', 'body': 'public', 'jsdPublic': True},
+            {'id': '2', 'body': 'internal', 'jsdPublic': False},
+            ))
+        self.assertEqual([c.jsdPublic for c in comments], [True, False])
+
+    def test_without_visibility(self):
+        """without jsdPublic the comments are fetched with their properties"""
+        self.assertIsNone(j2z.comment.get_embedded_comments(get_issue(
+            {'id': '1', 'body': 'public', 'jsdPublic': True},
+            {'id': '2', 'body': 'maybe internal'},
+            )))
+
+    def test_truncated(self):
+        """a truncated list is fetched"""
+        issue = get_issue({'id': '1', 'body': 'public', 'jsdPublic': True})
+        issue.raw['fields']['comment']['total'] = 2
+        self.assertIsNone(j2z.comment.get_embedded_comments(issue))
+
+
+if __name__ == '__main__':
+    unittest.main()
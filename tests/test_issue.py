@@ -0,0 +1,81 @@
+# vim: set fileencoding=utf-8
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4 smartindent ft=python
+# pylint: disable=fixme,invalid-name
+
+"""tests for jira 2 zammad migration : issue / ticket"""
+
+import unittest
+import j2z.issue
+
+
+class ResultList(list):
+    """page of a jira search"""
+    maxResults = 0
+
+
+class Tickets(list):
+    """page of a zammad ticket search"""
+    def is_last_page(self):
+        """one page only"""
+        return True
+
+
+class ZammadTickets:  # pylint: disable=too-few-public-methods
+    """ticket search keeping the per_page like zammad_py"""
+    def __init__(self, tickets):
+        """init the tickets"""
+        self.ticket = self
+        self.per_page = 10
+        self.tickets = tickets
+
+    def search(self, query, filters=None):  # pylint: disable=unused-argument
+        """return all tickets"""
+        self.per_page = filters.get('per_page', self.per_page)
+        return Tickets(self.tickets)
+
+
+class TicketIndexTest(unittest.TestCase):
+    """j2z.issue.TicketIndex"""
+    def setUp(self):
+        """use a local zammad"""
+        self.zammad = ZammadTickets([{'id': 1, 'number': '31001', 'jira_key': 'X-1'}])
+        self.saved = (j2z.issue.zammad, j2z.issue.mapping)
+        j2z.issue.zammad = self.zammad
+        j2z.issue.mapping = {}
+
+    def tearDown(self):
+        """restore the connectors"""
+        j2z.issue.zammad, j2z.issue.mapping = self.saved
+
+    def test_load(self):
+        """the index answers lookups and the search page size is restored"""
+        index = j2z.issue.TicketIndex()
+        index.load('jira_key')
+        self.assertEqual(self.zammad.per_page, 10)
+        self.assertTrue(index.isIndexed('jira_key'))
+        self.assertFalse(index.isIndexed('number'))
+        self.assertEqual(index.get('X-1')['id'], 1)
+        self.assertIsNone(index.get('X-2'))
+
+
+class PageSizeTest(unittest.TestCase):
+    """adaptive page size of the jira search"""
+    def test_time(self):
+        """the page size follows the response time"""
+        pagesize = j2z.issue.PageSize(50, seconds=5.0)
+        pagesize.update(ResultList(range(50)), 1.0)
+        self.assertEqual(pagesize.size, 100)
+        pagesize.update(ResultList(range(100)), 20.0)
+        self.assertEqual(pagesize.size, 50)
+
+    def test_payload(self):
+        """large pages shrink the page size, even if they are fast"""
+        pagesize = j2z.issue.PageSize(50, seconds=5.0, payload=1000)
+        pagesize.update(ResultList(range(50)), 0.1, 1500)
+        self.assertEqual(pagesize.size, 33)
+        pagesize.update(ResultList(range(33)), 0.1, 330)
+        self.assertEqual(pagesize.size, 66)
+
+
+if __name__ == '__main__':
+    unittest.main()
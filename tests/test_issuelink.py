@@ -0,0 +1,160 @@
+# vim: set fileencoding=utf-8
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4 smartindent ft=python
+# pylint: disable=fixme,invalid-name
+
+"""tests for jira 2 zammad migration : issuelinks / ticket"""
+
+import unittest
+import unittest.mock
+import j2z.issue
+import j2z.issuelink
+import j2z.ledger
+import j2z.metrics
+
+REVERSE_LINK_TYPE = {'normal': 'normal', 'parent': 'child', 'child': 'parent'}
+
+
+class ZammadLinks:
+    """links stored like zammad: (source id, target id, type)"""
+    def __init__(self):
+        """init the link store"""
+        self.link = self
+        self.stored = set()
+        # ticket number -> id
+        self.numbers = {}
+
+    def add(self, target, source_number, link_type='normal'):
+        """store a link like zammad_py: target by id, source by number"""
+        self.stored.add((self.numbers[source_number], target, link_type))
+
+    def get(self, ticket_id):
+        """list the links of a ticket like Link.list: reversed on the source side"""
+        links = []
+        for source, target, link_type in self.stored:
+            if source == ticket_id:
+                links.append({
+                    'link_type': REVERSE_LINK_TYPE[link_type], 'link_object': 'Ticket',
+                    'link_object_value': str(target)
+                    })
+            if target == ticket_id:
+                links.append({
+                    'link_type': link_type, 'link_object': 'Ticket',
+                    'link_object_value': str(source)
+                    })
+        return {'links': links}
+
+
+class CanonicalLinkTest(unittest.TestCase):
+    """canonical_link and LinkEngine._existing"""
+    def setUp(self):
+        """use a local link store"""
+        self.zammad = ZammadLinks()
+        self._zammad = j2z.issuelink.zammad
+        j2z.issuelink.zammad = self.zammad
+
+    def tearDown(self):
+        """restore the connector"""
+        j2z.issuelink.zammad = self._zammad
+
+    def test_canonical_link(self):
+        """both directions of a link have the same representation"""
+        canonical_link = j2z.issuelink.canonical_link
+        self.assertEqual(canonical_link(110, 109, 'normal'), canonical_link(109, 110, 'normal'))
+        self.assertEqual(canonical_link(1, 2, 'parent'), canonical_link(2, 1, 'child'))
+        self.assertNotEqual(canonical_link(1, 2, 'parent'), canonical_link(2, 1, 'parent'))
+        self.assertNotEqual(canonical_link(1, 2, 'child'), canonical_link(1, 2, 'parent'))
+
+    def test_existing_round_trip(self):
+        """a stored link is found from both tickets, in the same representation"""
+        for source, target in [(110, 109), (109, 110)]:
+            for link_type in ['normal', 'parent', 'child']:
+                self.zammad.stored = {(source, target, link_type)}
+                expected = j2z.issuelink.canonical_link(source, target, link_type)
+                for ticket_id in (source, target):
+                    with self.subTest(link=(source, target, link_type), ticket=ticket_id):
+                        self.assertEqual(
+                            j2z.issuelink.LinkEngine._existing(ticket_id),  # pylint: disable=protected-access
+                            {expected}
+                            )
+
+    def test_existing_opposite_direction(self):
+        """a parent link in the opposite direction is not the same link"""
+        self.zammad.stored = {(1, 2, 'parent')}
+        self.assertNotIn(
+            j2z.issuelink.canonical_link(2, 1, 'parent'),
+            j2z.issuelink.LinkEngine._existing(1)  # pylint: disable=protected-access
+            )
+
+
+class LinkEngineTest(unittest.TestCase):
+    """LinkEngine.apply with failing zammad requests"""
+    CONFIG = {
+        'mapping': {'issue': {'key': {'jira': 'key', 'zammad': 'number'}}},
+        'issuelinks': {'directions': ['outwardIssue'], 'match_all_unmapped_to_normal': True},
+        }
+
+    def setUp(self):
+        """local link store, a graph of two links and tickets 1 - 3 for the issues X-1 - X-3"""
+        self.zammad = ZammadLinks()
+        self.saved = (j2z.issuelink.zammad, j2z.issuelink.config, j2z.issuelink.LINK_GRAPH)
+        self.zammad.numbers = {'X-1': 1, 'X-2': 2, 'X-3': 3}
+        j2z.issuelink.zammad = self.zammad
+        j2z.issuelink.config = self.CONFIG
+        j2z.issuelink.LINK_GRAPH = j2z.issuelink.LinkGraph()
+        j2z.issuelink.LINK_GRAPH.links = {
+            'X-1': {('outwardIssue', 'X-2', 'relates to')},
+            'X-3': {('outwardIssue', 'X-2', 'relates to')},
+            }
+        self.failing = set()
+        patcher = unittest.mock.patch('j2z.issue.get_zammad_issue', self.get_zammad_issue)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        """restore connector, config and graph"""
+        j2z.issuelink.zammad, j2z.issuelink.config, j2z.issuelink.LINK_GRAPH = self.saved
+
+    def get_zammad_issue(self, ident, issueidentfield):
+        """ticket search"""
+        self.assertEqual(issueidentfield, 'number')
+        if ident in self.failing:
+            raise RuntimeError('503 Service Unavailable')
+        return {'id': int(ident[2:]), 'number': ident}
+
+    def test_apply(self):
+        """the links are created once"""
+        stats = j2z.issuelink.LinkEngine(2).apply(['X-1', 'X-3'])
+        self.assertEqual((stats['created'], stats['existing']), (2, 0))
+        stats = j2z.issuelink.LinkEngine(2).apply(['X-1', 'X-3'])
+        self.assertEqual((stats['created'], stats['existing']), (0, 2))
+
+    def test_created_tickets(self):
+        """the tickets created by the run are resolved without a search"""
+        index = j2z.issue.TicketIndex()
+        for ident in ['X-1', 'X-2', 'X-3']:
+            index.add(ident, self.get_zammad_issue(ident, 'number'))
+        self.failing.update(['X-1', 'X-2', 'X-3'])
+        with unittest.mock.patch('j2z.issue.TICKET_INDEX', index):
+            stats = j2z.issuelink.LinkEngine(2).apply(['X-1', 'X-3'])
+        self.assertEqual((stats['created'], stats['unresolved']), (2, 0))
+
+    def test_failed_search(self):
+        """a failed ticket search leaves the links of the ticket unresolved"""
+        self.failing.add('X-3')
+        stats = j2z.issuelink.LinkEngine(2).apply(['X-1', 'X-3'])
+        self.assertEqual((stats['created'], stats['unresolved']), (1, 1))
+
+    def test_failed_link_list(self):
+        """links of a ticket whose links can not be listed fail"""
+        get = self.zammad.get
+        def failing_get(ticket_id):
+            if ticket_id == 1:
+                raise RuntimeError('circuit open')
+            return get(ticket_id)
+        self.zammad.get = failing_get
+        stats = j2z.issuelink.LinkEngine(2).apply(['X-1', 'X-3'])
+        self.assertEqual((stats['created'], stats['failed']), (1, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
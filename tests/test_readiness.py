@@ -0,0 +1,65 @@
+# vim: set fileencoding=utf-8
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4 smartindent ft=python
+# pylint: disable=fixme,invalid-name
+
+"""tests for jira 2 zammad migration : search index readiness"""
+
+import re
+import time
+import types
+import unittest
+import j2z.metrics
+import j2z.readiness
+
+
+class ZammadTickets:  # pylint: disable=too-few-public-methods
+    """ticket search that finds every ticket"""
+    def __init__(self):
+        """init the search counter"""
+        self.ticket = self
+        self.searches = []
+
+    def search(self, query, filters=None):  # pylint: disable=unused-argument
+        """return the tickets of the query"""
+        numbers = re.findall(r'number:"([^"]+)"', query)
+        self.searches.append(numbers)
+        return [{'number': number} for number in numbers]
+
+
+class IndexReadinessTest(unittest.TestCase):
+    """batched searches of j2z.readiness.IndexReadiness"""
+    def setUp(self):
+        """use a local zammad"""
+        self.zammad = ZammadTickets()
+        self.saved = (j2z.readiness.zammad, j2z.readiness.mapping)
+        j2z.readiness.zammad = self.zammad
+        j2z.readiness.mapping = {}
+
+    def tearDown(self):
+        """restore the connectors"""
+        j2z.readiness.zammad, j2z.readiness.mapping = self.saved
+
+    def test_batches(self):
+        """tickets created in a row share the searches"""
+        readiness = j2z.readiness.IndexReadiness(timeout=10, delay=0.2, batchsize=50)
+        for num in range(40):
+            readiness.expect_ticket(num, types.SimpleNamespace(id=num))
+            time.sleep(0.01)
+        readiness.wait()
+        self.assertEqual(readiness.stats['ticket']['verified'], 40)
+        self.assertEqual(sorted(int(n) for numbers in self.zammad.searches for n in numbers),
+                         list(range(40)))
+        # 0.4s of new tickets, a search every 0.2s
+        self.assertLessEqual(len(self.zammad.searches), 4)
+
+    def test_batchsize(self):
+        """a search is limited to batchsize tickets"""
+        readiness = j2z.readiness.IndexReadiness(timeout=10, delay=0.1, batchsize=10)
+        for num in range(25):
+            readiness.expect_ticket(num, types.SimpleNamespace(id=num))
+        readiness.wait()
+        self.assertEqual([len(numbers) for numbers in self.zammad.searches], [10, 10, 5])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,25 @@
+# vim: set fileencoding=utf-8
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4 smartindent ft=python
+# pylint: disable=fixme,invalid-name
+
+"""tests for jira 2 zammad migration : issue / ticket tags"""
+
+import unittest
+import j2z.tags
+
+
+class TagsTest(unittest.TestCase):
+    """tags of a new ticket and the missing tags"""
+    def test_join_tags(self):
+        """tags with a comma are not joined"""
+        self.assertEqual(j2z.tags.join_tags(['Backup', 'Mail, imap', 'AB']), 'Backup,AB')
+
+    def test_missing_tags(self):
+        """a tag with a comma is added afterwards"""
+        tags = ['Backup', 'Mail, imap', 'AB']
+        existing = j2z.tags.join_tags(tags).split(',')
+        self.assertEqual(j2z.tags.get_missing_tags(tags, existing), ['Mail, imap'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+# vim: set fileencoding=utf-8
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4 smartindent ft=python
+# pylint: disable=fixme,invalid-name
+
+"""tests for jira 2 zammad migration : http transport"""
+
+import unittest
+import unittest.mock
+import requests
+import j2z.metrics
+import j2z.transport
+
+
+class RateLimiterTest(unittest.TestCase):
+    """adaptive rate limit of j2z.transport.RateLimiter"""
+    def window(self, limiter, latencies):
+        """run a window of requests with the given latencies"""
+        for latency in latencies:
+            self.assertEqual(limiter.try_acquire(), 0)
+            limiter.release(latency)
+
+    def test_increase(self):
+        """a window below the target latency raises the limit"""
+        limiter = j2z.transport.RateLimiter('test', target=0.5, maxlimit=10, window=10)
+        limit = limiter.limit
+        self.window(limiter, [0.1] * 10)
+        self.assertEqual(limiter.limit, limit + 1)
+
+    def test_p95_outlier(self):
+        """the slowest of 10 requests is the p95 latency of the window"""
+        limiter = j2z.transport.RateLimiter('test', target=0.5, maxlimit=10, window=10)
+        limit = limiter.limit
+        self.window(limiter, [0.1] * 9 + [5.0])
+        self.assertEqual(limiter.stats['increased'], 0)
+        self.assertLess(limiter.limit, limit)
+
+
+class TransportAdapterTest(unittest.TestCase):
+    """rate limit slots of j2z.transport.TransportAdapter"""
+    def test_release_on_error(self):
+        """a request failing with any error releases its slot"""
+        transport = j2z.transport.Transport({'ratelimit': {'maxconcurrency': 1}})
+        adapter = j2z.transport.TransportAdapter(transport)
+        request = requests.Request('GET', 'https://zammad.example.org/api/v1/tickets').prepare()
+        with unittest.mock.patch(
+                'requests.adapters.HTTPAdapter.send',
+                side_effect=requests.exceptions.InvalidHeader('Retry-After')
+                ):
+            with self.assertRaises(requests.exceptions.InvalidHeader):
+                adapter.send(request)
+        limiter = transport.get_limiter(request.url)
+        self.assertEqual(limiter.try_acquire(), 0)
+
+    def test_response_size(self):
+        """the size of the last response of a thread"""
+        transport = j2z.transport.Transport()
+        adapter = j2z.transport.TransportAdapter(transport)
+        request = requests.Request('GET', 'https://jira.example.org/rest/api/2/search').prepare()
+        response = requests.Response()
+        response.status_code = 200
+        response._content = b'{"issues": []}'  # pylint: disable=protected-access
+        self.assertIsNone(transport.get_response_size())
+        with unittest.mock.patch('requests.adapters.HTTPAdapter.send', return_value=response):
+            adapter.send(request)
+            self.assertEqual(transport.get_response_size(), 14)
+            adapter.send(request, stream=True)
+            self.assertIsNone(transport.get_response_size())
+
+
+if __name__ == '__main__':
+    unittest.main()
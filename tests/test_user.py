@@ -0,0 +1,77 @@
+# vim: set fileencoding=utf-8
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4 smartindent ft=python
+# pylint: disable=fixme,invalid-name
+
+"""tests for jira 2 zammad migration : user"""
+
+import os
+import tempfile
+import unittest
+import j2z.user
+
+
+class UserCacheTest(unittest.TestCase):
+    """j2z.user.UserCache"""
+    def setUp(self):
+        """empty cache"""
+        self.mapping = j2z.user.mapping
+        j2z.user.mapping = {}
+        self.cache = self.create()
+
+    def tearDown(self):
+        """restore the mapping"""
+        j2z.user.mapping = self.mapping
+
+    def create(self):
+        """return a empty cache"""
+        return j2z.user.UserCache()
+
+    def test_invalidate(self):
+        """all idents of a zammad id are removed"""
+        self.cache.cacheUsers([
+            ('a@example.org', {'id': 1}), ('A@example.org', {'id': 1}),
+            ('alias@example.org', {'id': 1}), ('b@example.org', {'id': 2}),
+            ])
+        self.cache.setComplete(True)
+        self.cache.invalidate(1)
+        self.assertFalse(self.cache.isCached('a@example.org'))
+        self.assertFalse(self.cache.isCached('alias@example.org'))
+        self.assertTrue(self.cache.isCached('b@example.org'))
+        self.assertFalse(self.cache.isComplete())
+
+    def test_invalidate_moved_ident(self):
+        """a ident cached again for another id is not removed with the old id"""
+        self.cache.cache('a@example.org', {'id': 1})
+        self.cache.cache('a@example.org', {'id': 2})
+        self.cache.invalidate(1)
+        self.assertEqual(self.cache.getUser('a@example.org')['id'], 2)
+        self.cache.invalidate(2)
+        self.assertFalse(self.cache.isCached('a@example.org'))
+
+
+class SQLiteUserCacheTest(UserCacheTest):
+    """j2z.user.SQLiteUserCache"""
+    def create(self):
+        """return a empty cache db"""
+        self.tmpdir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        return j2z.user.SQLiteUserCache(os.path.join(self.tmpdir.name, 'users.db'))
+
+    def tearDown(self):
+        """remove the cache db"""
+        self.cache._db.close()  # pylint: disable=protected-access
+        self.tmpdir.cleanup()
+        super().tearDown()
+
+    def test_persisted(self):
+        """the users are stored in the db"""
+        self.cache.cacheUsers([('a@example.org', {'id': 1, 'role_ids': [3], 'active': False})])
+        cache = j2z.user.SQLiteUserCache(self.cache.dbfile)
+        self.assertEqual(
+            cache.getUser('A@example.org'),
+            {'id': 1, 'role_ids': [3], 'active': False, 'email': 'A@example.org'}
+            )
+        cache._db.close()  # pylint: disable=protected-access
+
+
+if __name__ == '__main__':
+    unittest.main()